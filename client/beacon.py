@@ -29,98 +29,319 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-import pickle
+import time
+import heapq
+import logging
+import binascii
 import datetime
+import threading
+
+from collections import deque, namedtuple
 
 import const
 import logger
+import metrics
+from journal import Journal
+from logger import RateLimit
 
 logger = logger.get_logger(__name__)
 
+SAVE_TIME = metrics.histogram('beacon_save_seconds', 'Journal write time of one save')
+SAVED_RECORDS = metrics.counter('beacon_journal_records_total', 'Records written to visits journal')
+
+ACTIVE = 0  # beacon is still seen
+SAVED = 1  # visit is over, waits for spool
+
+
+def isoformat(t):
+    "Epoch seconds to ISO 8601 local time string"
+    return datetime.datetime.fromtimestamp(t).isoformat()
+
+
+def identity_str(identity):
+    "Readable beacon identity: uuid,major,minor"
+    mac, uuid, major, minor = identity
+    return "{},{},{}".format(binascii.hexlify(uuid).decode('ascii'), major, minor)
+
+
+# Finished visit as handed over to spool
+Message = namedtuple('Message', 'uid identity in_time out_time min_dist min_time')
+
+
+class Visit(object):
+    "One beacon visit, times are epoch seconds"
+    __slots__ = ('uid', 'beacon', 'in_time', 'out_time', 'min_dist', 'min_time', 'state')
+
+    def __init__(self, uid, beacon, in_time, out_time, min_dist, min_time, state=ACTIVE):
+        self.uid = uid  # unique visit number
+        self.beacon = beacon  # interned beacon id
+        self.in_time = in_time
+        self.out_time = out_time
+        self.min_dist = min_dist
+        self.min_time = min_time
+        self.state = state
+
+
+class Identities(object):
+    """
+    Interns beacon identities (mac, uuid, major, minor) to small int ids
+    Ids are reference counted by visits and reused when released
+    """
+
+    def __init__(self):
+        self.ids = {}  # identity: id
+        self.identities = []  # id: identity
+        self.refs = []
+        self.free = []
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get(self, identity):
+        "Returns id of identity or None"
+        return self.ids.get(identity)
+
+    def identity(self, beacon_id):
+        return self.identities[beacon_id]
+
+    def acquire(self, identity):
+        "Returns id of identity, adds reference"
+        beacon_id = self.ids.get(identity)
+        if beacon_id is None:
+            if self.free:
+                beacon_id = self.free.pop()
+                self.identities[beacon_id] = identity
+                self.refs[beacon_id] = 0
+            else:
+                beacon_id = len(self.identities)
+                self.identities.append(identity)
+                self.refs.append(0)
+            self.ids[identity] = beacon_id
+        self.refs[beacon_id] += 1
+        return beacon_id
+
+    def release(self, beacon_id):
+        "Removes reference, forgets identity when nothing refers to it"
+        self.refs[beacon_id] -= 1
+        if self.refs[beacon_id] == 0:
+            del self.ids[self.identities[beacon_id]]
+            self.identities[beacon_id] = None
+            self.free.append(beacon_id)
+
 
 class Beacons():
     """
     Beacons temporary storage structure
-    dict[beacon] = [in_time, last_seen_time, min_dist, last(deque(5))]
+    Beacon identities are interned to ids, every visit is a Visit record
+    active[beacon_id] = Visit of beacon still seen, saved[uid] = finished Visit loaded from older save files
+    Active visits are indexed by expiry heap of (last_seen_time + TIMEOUT, uid, visit),
+    heap items of beacons seen again are rescheduled when popped
+
+    Changes are written to journal by save() as ('put', uid, identity, in_time, out_time, min_dist, min_time, state),
+    ('upd', uid, out_time, min_dist, min_time) for updated active visits and ('del', uid) records
+
+    Finished visits are put to spool as Messages and forgotten, delivery is spool business
+
+    Threads: all state belongs to the scanner thread, which calls add() and tick().
+    Other threads never touch it and never make the scanner wait:
+    saver calls save(), tick() hands journal records over through a deque
     """
 
-    def __init__(self):
-        self.modified = False
+    def __init__(self, spool):
+        self.timeout = const.TIMEOUT
+        self.identities = Identities()
+        self.active = {}
+        self.saved = {}
+        self.expiry = []
+        self.next_uid = 0
+        self.records = deque()  # journal records for saver
+        self.dirty = {}  # uid: updated active visit
+        self.spool = spool
+        self.log_limit = RateLimit()  # per-beacon messages
+        self.flush_request = threading.Event()
+        self.flushed = threading.Event()
+        self.compact_request = False
 
+        self.journal = Journal(const.SAVE_FILE)
         try:
-            with open(const.SAVE_FILE, 'rb') as f:
-                self.beacons = pickle.load(f)
+            self.load()
         except:
-            logger.warning('Cannot load beacons')
-            self.beacons = {}
+            logger.error('Cannot load beacons', exc_info=True)
 
-    def in_time(self, beacon):
-        return self.beacons[beacon][0]
+    def __len__(self):
+        return len(self.active) + len(self.saved)
 
-    def out_time(self, beacon):
-        return self.beacons[beacon][1]
+    def identity(self, visit):
+        "Returns (mac, uuid, major, minor) of visit beacon"
+        return self.identities.identity(visit.beacon)
 
-    def min_dist(self, beacon):
-        return self.beacons[beacon][2]
+    def create(self, identity, in_time, out_time, min_dist, min_time, state, uid=None):
+        if uid is None:
+            uid = self.next_uid
+            self.records.append(('put', uid, identity, in_time, out_time, min_dist, min_time, state))
+        self.next_uid = max(self.next_uid, uid + 1)
+        visit = Visit(uid, self.identities.acquire(identity), in_time, out_time, min_dist, min_time, state)
+        if state == ACTIVE:
+            self.active[visit.beacon] = visit
+            self.schedule(visit, out_time + self.timeout)
+        else:
+            self.saved[visit.uid] = visit
+        return visit
 
-    def min_time(self, beacon):
-        return self.beacons[beacon][3]
+    def schedule(self, visit, deadline):
+        heapq.heappush(self.expiry, (deadline, visit.uid, visit))
 
-    def add(self, beacon, time, dist):
-        "Updates beacon if exist, creates new beacon otherwise"
-        try:
-            in_time, last_seen_time, min_dist, min_time = self.beacons.pop(beacon)
-            new_min_dist = dist if dist < min_dist else min_dist
-            new_min_time = time if dist < min_dist else min_time
-            logger.debug("{}, dist = {}".format(beacon, dist))
-            self.beacons[beacon] = [in_time, time, new_min_dist, new_min_time]
-        except:
-            logger.info("{}, dist = {} NEW".format(beacon, dist))
-            self.beacons[beacon] = [time, time, dist, time]
-        finally:
-            self.modified = True
+    def add(self, identity, now, dist):
+        "Updates beacon visit if exist, creates new visit otherwise"
+        beacon_id = self.identities.get(identity)
+        visit = self.active.get(beacon_id) if beacon_id is not None else None
+        if visit is None:
+            if self.log_limit.allow(identity, now):
+                logger.info("%s, dist = %s NEW", identity_str(identity), dist)
+            self.create(identity, now, now, dist, now, ACTIVE)
+        else:
+            if logger.isEnabledFor(logging.DEBUG) and self.log_limit.allow(identity, now):
+                logger.debug("%s, dist = %s", identity_str(identity), dist)
+            visit.out_time = now
+            if dist < visit.min_dist:
+                visit.min_dist = dist
+                visit.min_time = now
+            self.dirty[visit.uid] = visit
 
-    def add_preserve(self, beacon):
-        "Preserves ready-to-send message"
-        try:
-            beacon_id = beacon + ',' + self.min_time(beacon).isoformat() + 'save'
-            in_time, last_seen_time, min_dist, min_time = self.beacons.pop(beacon)
-            logger.debug("preserve {}, min_dist = {}, min_time = {}".format(beacon, min_dist, min_time))
-            self.beacons[beacon_id] = [in_time, last_seen_time, min_dist, min_time]
-            self.modified = True
-        except Exception as e:
-            logger.error("exception in preserve {}".format(beacon), exc_info=True)
-
-    def remove(self, beacon):
-        "Removes beacon"
-        try:
-            self.beacons.pop(beacon)
-            self.modified = True
-        except:
-            pass
+    def finish(self, visit, now):
+        "Puts finished visit to spool and forgets it"
+        if self.active.get(visit.beacon) is visit:
+            del self.active[visit.beacon]
+        else:
+            del self.saved[visit.uid]
+        visit.state = SAVED
+        self.dirty.pop(visit.uid, None)
+        self.spool.put(Message(visit.uid, self.identity(visit), visit.in_time, visit.out_time,
+                               visit.min_dist, visit.min_time), now)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("finish %s, min_dist = %s, min_time = %s",
+                         identity_str(self.identity(visit)), visit.min_dist, isoformat(visit.min_time))
+        self.identities.release(visit.beacon)
+        self.records.append(('del', visit.uid))
 
-    def save(self):
-        "Try to save beacons if modified"
-        try:
-            if self.modified:
-                with open(const.SAVE_FILE, 'wb') as f:
-                    pickle.dump(self.beacons, f, protocol=pickle.HIGHEST_PROTOCOL)
-                    f.flush()
-                self.modified = False
-                logger.debug("{} records saved to pkl".format(len(self.beacons)))
-        except:
-            logger.error("pkl save error!")
+    def snapshot(self):
+        "Returns all visits as plain tuples"
+        return {'version': 3,
+                'visits': [(visit.uid, self.identity(visit), visit.in_time, visit.out_time,
+                            visit.min_dist, visit.min_time, visit.state)
+                           for visits in (self.active, self.saved) for visit in list(visits.values())]}
+
+    def load(self):
+        "Restores visits from snapshot and replays journal"
+        snapshot, records = self.journal.load()
+        visits = {}  # uid: [identity, in_time, out_time, min_dist, min_time, state]
+        legacy = snapshot is not None and not (isinstance(snapshot, dict) and snapshot.get('version') == 3)
+        if legacy:
+            visits = dict(enumerate(legacy_visits(snapshot)))
+        elif snapshot is not None:
+            for record in snapshot['visits']:
+                visits[record[0]] = list(record[1:])
+
+        for record in records:
+            if record[0] == 'put':
+                visits[record[1]] = list(record[2:])
+            elif record[0] == 'upd':
+                if record[1] in visits:
+                    visits[record[1]][2:5] = record[2:]
+            elif record[0] == 'del':
+                visits.pop(record[1], None)
 
-    def check(self, beacon, time):
-        "Returns True if beacon exists and was seen more then TIMEOUT seconds ago"
+        for uid in sorted(visits):
+            self.create(*visits[uid], uid=uid)
+        logger.info("%s visits loaded, %s journal records replayed", len(visits), len(records))
+        if records or legacy:
+            self.journal.compact(self.snapshot())
+
+    def save(self, timeout=const.SAVE_TIMEOUT):
+        """
+        Saver thread: writes changes since last save to journal, compacts it when it is too big
+        Updated active visits are collected by next scanner thread tick()
+        Spool is flushed first: finished visits are put to spool before their 'del' records are made,
+        so every visit is always on disk either here or in spool
+        """
         try:
-            if (time - self.beacons[beacon][1]).seconds > const.TIMEOUT:
-                return True
+            self.flushed.clear()
+            self.flush_request.set()
+            self.flushed.wait(timeout)
+
+            started = metrics.clock()
+            pending = []
+            while self.records:
+                pending.append(self.records.popleft())
+            self.spool.flush()
+
+            records = []
+            count = 0
+            for record in pending:
+                if record[0] == 'snapshot':
+                    self.journal.append(records)
+                    self.journal.compact(record[1])
+                    records = []
+                else:
+                    records.append(record)
+                    count += 1
+            self.journal.append(records)
+            if self.journal.full():
+                self.compact_request = True
+            SAVE_TIME.observe(metrics.clock() - started)
+            SAVED_RECORDS.inc(count)
+            if count:
+                logger.debug("%s records saved to journal", count)
         except:
-            pass
-        return False
+            logger.error("journal save error!", exc_info=True)
+
+    def tick(self, now=None):
+        "Scanner thread housekeeping: puts expired visits to spool, feeds saver"
+        now = now or time.time()
+        if self.saved:
+            for visit in list(self.saved.values()):
+                self.finish(visit, now)
+        for visit in self.expired(now):
+            self.finish(visit, now)
+        if self.flush_request.is_set():
+            self.flush_request.clear()
+            for visit in self.dirty.values():
+                self.records.append(('upd', visit.uid, visit.out_time, visit.min_dist, visit.min_time))
+            self.dirty = {}
+            if self.compact_request:
+                self.compact_request = False
+                self.records.append(('snapshot', self.snapshot()))
+            self.flushed.set()
+
+    def expired(self, now):
+        "Returns active visits seen more then TIMEOUT seconds ago, checks only heap items due by now"
+        expired = []
+        while self.expiry and self.expiry[0][0] < now:
+            deadline, uid, visit = heapq.heappop(self.expiry)
+            if visit.state != ACTIVE:
+                continue
+            deadline = visit.out_time + self.timeout
+            if deadline < now:
+                expired.append(visit)
+            else:
+                heapq.heappush(self.expiry, (deadline, uid, visit))
+        return expired
+
+
+def legacy_visits(data):
+    "Converts older save file formats to visit lists"
+    if isinstance(data, list):  # list of (identity, in_time, out_time, min_dist, min_time, state)
+        return [list(record) for record in data]
+    visits = []  # dict[beacon string] = [in_time, out_time, min_dist, min_time] with datetimes
+    for key, (in_time, out_time, min_dist, min_time) in data.items():
+        mac, uuid, major, minor = key.split(',')[:4]
+        identity = (binascii.unhexlify(mac.replace(':', ''))[::-1], binascii.unhexlify(uuid),
+                    int(major), int(minor))
+        state = SAVED if key[-4:] == 'save' else ACTIVE
+        visits.append([identity, epoch(in_time), epoch(out_time), min_dist, epoch(min_time), state])
+    return visits
+
 
-    def ready_to_send(self):
-        "Returns iterable with ready-to-send beacons"
-        return [b for b in self.beacons
-                if self.check(b, datetime.datetime.now())]
+def epoch(dt):
+    "Naive local datetime to epoch seconds"
+    return time.mktime(dt.timetuple()) + dt.microsecond / 1e6
@@ -32,32 +32,37 @@ SOFTWARE.
 import blescan
 import sys
 import time
-import datetime
+import signal
 import requests
 import threading
-import math
+import binascii
+import json
+import gzip
+import io
 import os
 import const
 
-import bluetooth._bluetooth as bluez
-
-from beacon import Beacons
+from beacon import Beacons, isoformat
+from spool import Spool, CircuitBreaker
+from recorder import Recorder
+from distance import DistanceModel
 import processors
+import metrics
+from profiler import Profiler
+import capture
+import ringbuffer
 import logger
 
 logger = logger.get_logger(__name__)
 
-
-def getrange(txPower, rssi):
-    "https://stackoverflow.com/questions/20416218/understanding-ibeacon-distancing"
-    if txPower == 0:
-        txPower = 1
-    ratio = float(rssi) / txPower
-    if (ratio < 1.0):
-        return round(math.pow(ratio, 10))
-    else:
-        distance = (0.89976) * math.pow(ratio, 7.7095) + 0.111
-    return round(distance)
+STAGE_HELP = 'Processing time of one batch by stage'
+STAGE_TICK = metrics.histogram('beacon_stage_seconds', STAGE_HELP, stage='tick')
+STAGE_FILTER = metrics.histogram('beacon_stage_seconds', STAGE_HELP, stage='filter')
+STAGE_GETRANGE = metrics.histogram('beacon_stage_seconds', STAGE_HELP, stage='getrange')
+STAGE_ADD = metrics.histogram('beacon_stage_seconds', STAGE_HELP, stage='add')
+PROCESSED = metrics.counter('beacon_adverts_processed_total', 'Adverts passed to rssi filter')
+SEND_TIME = metrics.histogram('beacon_send_seconds', 'Server request time, failed ones too')
+SEND_FAILURES = metrics.counter('beacon_send_failures_total', 'Failed server requests')
 
 
 def getserial():
@@ -74,44 +79,108 @@ def getserial():
     return cpuserial
 
 
-def check_and_send(beacons, processor):
-    "Check if beacon wasn't seen during TIMEOUT and send it to server"
+def message_json(message, serial):
+    "Server message for finished visit"
+    mac, uuid, major, minor = message.identity
+    return {
+        'raspi_serial': serial,
+        'ibeacon_uuid': binascii.hexlify(uuid).decode('ascii'),
+        'ibeacon_major': str(major),
+        'ibeacon_minor': str(minor),
+        'in_time': isoformat(message.in_time),
+        'out_time': isoformat(message.out_time),
+        'min_dist': str(message.min_dist),
+        'min_time': isoformat(message.min_time)
+    }
+
+
+def send_batch(session, messages, serial):
+    "Posts messages in one gzip-compressed request, returns server status of every message"
+    body = io.BytesIO()
+    with gzip.GzipFile(fileobj=body, mode='wb') as f:
+        f.write(json.dumps([message_json(message, serial) for message in messages]).encode('utf-8'))
+    res = session.post(const.SERVER_BATCH_URL, data=body.getvalue(), timeout=const.SEND_TIMEOUT,
+                       headers={'Content-Type': 'application/json', 'Content-Encoding': 'gzip'})
+    res.raise_for_status()
+    return [result.get('status') for result in res.json()]
+
+
+def check_and_send(spool):
+    "Sends spooled visits to server in batches, backs off while server is down"
+    session = requests.Session()  # keeps connection alive
+    serial = getserial()
+    breaker = CircuitBreaker()
+    metrics.gauge('beacon_breaker_open', lambda: int(breaker.state != 'closed'), 'Server circuit breaker is not closed')
     while True:
-        ready_to_send = list(beacons.ready_to_send())
-        for beacon in ready_to_send:
-            if beacon[-4:] == 'save':
-                uuid, major, minor = beacon.split(',')[1:4]
-                json = {
-                    'raspi_serial': getserial(),
-                    'ibeacon_uuid': uuid,
-                    'ibeacon_major': str(major),
-                    'ibeacon_minor': str(minor),
-                    'in_time': beacons.in_time(beacon).isoformat(),
-                    'out_time': beacons.out_time(beacon).isoformat(),
-                    'min_dist': str(beacons.min_dist(beacon)),
-                    'min_time': beacons.min_time(beacon).isoformat()
-                }
-                logger.debug("sending {},{},{}; min_dist = {}".format(uuid, major, minor, beacons.min_dist(beacon)))
-                try:
-                    res = requests.post(const.SERVER_URL, json=json, timeout=2)
-                    if res.ok:
-                        logger.info("sent {},{},{}; min_dist = {}".format(uuid, major, minor, beacons.min_dist(beacon)))
-                        beacons.remove(beacon)
-                        processor.clear(beacon)
-                except:
-                    logger.debug('Server not responding')
-            else:
-                beacons.add_preserve(beacon)
-        time.sleep(const.TIMEOUT)
-
-
-def save_pkl(beacons):
-    "Saves beacons to file periodically"
+        now = time.time()
+        if not breaker.allow(now):
+            time.sleep(min(breaker.retry_at - now, const.SEND_INTERVAL))
+            continue
+        # half-open breaker probes server with single message
+        items = spool.peek(1 if breaker.state == 'half-open' else const.BATCH_SIZE)
+        if not items or (len(items) < const.BATCH_SIZE and breaker.state == 'closed' and
+                         now - items[0][1] < const.BATCH_MAX_AGE):
+            time.sleep(const.SEND_INTERVAL)
+            continue
+
+        started = metrics.clock()
+        try:
+            statuses = send_batch(session, [payload for seq, put_time, payload in items], serial)
+        except:
+            logger.debug('Server not responding')
+            SEND_TIME.observe(metrics.clock() - started)
+            SEND_FAILURES.inc()
+            breaker.failure(now)
+            time.sleep(const.SEND_INTERVAL)
+            continue
+        SEND_TIME.observe(metrics.clock() - started)
+        breaker.success()
+        # duplicate means server has it already, error means it never will
+        delivered = [item[0] for item, status in zip(items, statuses) if status in ('ok', 'duplicate')]
+        rejected = [item[0] for item, status in zip(items, statuses) if status == 'error']
+        spool.remove(delivered)
+        spool.remove(rejected, 'rejected')
+        logger.info("sent %s of %s visits", len(delivered), len(items))
+        if rejected:
+            logger.warning("server rejected %s visits", len(rejected))
+        if len(delivered) + len(rejected) < len(items):
+            breaker.failure(now)
+            time.sleep(const.SEND_INTERVAL)
+
+
+def save_pkl(beacons, profiler):
+    "Saves beacons to file periodically, writes stats file and checks profiler trigger too"
     while True:
         beacons.save()
+        profiler.check_trigger()
+        if const.METRICS_FILE:
+            try:
+                metrics.write_stats(const.METRICS_FILE)
+            except:
+                logger.error("stats file write error", exc_info=True)
         time.sleep(const.SAVE_TIMEOUT)
 
 
+def register_metrics(advert_filter, processor, beacons, spool, recorder):
+    "Exposes counters kept by pipeline parts, they are read only when metrics are"
+    for key in advert_filter.counters:
+        metrics.gauge('beacon_adverts_total', lambda key=key: advert_filter.counters[key],
+                      'Advertising reports by filter result', result=key)
+    metrics.gauge('beacon_filter_states', lambda: len(processor.beacons), 'Beacons tracked by rssi filter')
+    metrics.gauge('beacon_filter_evicted_total', lambda: processor.beacons.evicted, 'Rssi filter states evicted')
+    metrics.gauge('beacon_visits_active', lambda: len(beacons.active), 'Beacons seen now')
+    metrics.gauge('beacon_spool_pending', lambda: len(spool), 'Messages waiting to be sent')
+    for key in spool.counters:
+        metrics.gauge('beacon_spool_messages_total', lambda key=key: spool.counters[key],
+                      'Spooled messages by outcome', outcome=key)
+    metrics.gauge('beacon_spool_oldest_seconds', lambda: time.time() - spool.peek(1)[0][1] if len(spool) else 0,
+                  'Age of the oldest message waiting to be sent')
+    if recorder is not None:
+        for key in recorder.counters:
+            metrics.gauge('beacon_recorder_total', lambda key=key: recorder.counters[key],
+                          'Capture recorder counters', kind=key)
+
+
 def correct_time():
     "NTP client"
     try:
@@ -126,73 +195,108 @@ def correct_time():
         logger.error('Could not sync with time server.', exc_info=True)
 
 
+def process(adverts, now, processor, distance_model, beacons):
+    "Feeds adverts through rssi filter and distance model to beacons"
+    t0 = metrics.clock()
+    beacon_ids = [advert[:4] for advert in adverts]  # (mac, uuid, major, minor)
+    rssi = [-99 if advert.rssi < -99 else advert.rssi for advert in adverts]  # rssi peak fix
+    filtered = processor.filter_batch(beacon_ids, rssi, now)
+    t1 = metrics.clock()
+    distances = [(i, distance_model.getrange(adverts[i].txpower, rssi_filtered, adverts[i].uuid, adverts[i].major))
+                 for i, rssi_filtered in filtered]
+    t2 = metrics.clock()
+    for i, beacon_dist in distances:
+        if beacon_dist < const.MAX_RANGE:  # maximum range
+            beacons.add(beacon_ids[i], now, beacon_dist)
+    t3 = metrics.clock()
+    STAGE_FILTER.observe(t1 - t0)
+    STAGE_GETRANGE.observe(t2 - t1)
+    STAGE_ADD.observe(t3 - t2)
+    PROCESSED.inc(len(adverts))
+
+
+def terminate(signum, frame):
+    "SIGTERM handler, unwinds main loop"
+    raise SystemExit(0)
+
+
 def start(*args, **kwargs):
     "Main loop"
-    logger.info("Raspberry serial: {}".format(getserial()))
-
-    if const.DUMP:
-        csv = open('data.csv', 'w')
+    logger.info("Raspberry serial: %s", getserial())
 
     if const.TIME_SYNC:
         logger.info("Waiting for time sync")
         time.sleep(10)
         correct_time()
 
-    beacons = Beacons()
+    spool = Spool()
+    beacons = Beacons(spool)
+    distance_model = DistanceModel()
     # processor = processors.Kalman()
+    # processor = processors.WindowedKalman()
     processor = processors.OneSecondAverage()
 
-    timer_thread = threading.Thread(target=check_and_send, args=(beacons, processor))
+    recorder = Recorder() if const.DUMP else None
+
+    # capture processes are forked before any threads are started
+    advert_filter = blescan.AdvertFilter(const.IBEACON_PREFIX, const.ALLOWED_UUID,
+                                         const.ALLOWED_MAJOR, const.ALLOWED_MINOR)
+    if const.CAPTURE_PROCESS and ringbuffer.shared_memory is not None:
+        scanner = capture.RingScanner(const.HCI_DEVICES, advert_filter, recorder)
+    else:
+        if const.CAPTURE_PROCESS:
+            logger.warning("capture process needs python 3.8+, capturing in main process")
+        try:
+            scanner = capture.LocalScanner(const.HCI_DEVICES, advert_filter, recorder)
+            logger.info("ble thread started")
+        except Exception as e:
+            logger.error('Error accessing bluetooth device', exc_info=True)
+            sys.exit(1)
+
+    register_metrics(advert_filter, processor, beacons, spool, recorder)
+    if const.METRICS_PORT:
+        try:
+            metrics.serve(const.METRICS_PORT, const.METRICS_HOST)
+        except:
+            logger.error("Cannot start metrics endpoint", exc_info=True)
+
+    profiler = Profiler()
+    profiler.install()
+
+    timer_thread = threading.Thread(target=check_and_send, args=(spool,), name='sender')
     timer_thread.daemon = True
     timer_thread.start()
 
-    save_thread = threading.Thread(target=save_pkl, args=(beacons,))
+    save_thread = threading.Thread(target=save_pkl, args=(beacons, profiler), name='saver')
     save_thread.daemon = True
     save_thread.start()
 
-    dev_id = 0
-    try:
-        sock = bluez.hci_open_dev(dev_id)
-        blescan.hci_le_set_scan_parameters(sock)
-        blescan.hci_enable_le_scan(sock)
-        logger.info("ble thread started")
-    except Exception as e:
-        logger.error('Error accessing bluetooth device', exc_info=True)
-        sys.exit(1)
-
+    # service manager stops client with SIGTERM, scanner and capture file are closed on the way out
+    signal.signal(signal.SIGTERM, terminate)
     try:
         while True:
-            returnedList = blescan.parse_events(sock, 1)
-            for beacon in returnedList:
-                uuid, major, minor = beacon.split(',')[1:4]
-                if major in const.ALLOWED_MAJOR:
-                    beacon_id = beacon[:-8]
-                    if beacon_id[-2:] == ',,':  # double comma at end of string
-                        beacon_id = beacon_id[:-1]
-                    beacon_datetime = datetime.datetime.now()
-                    txpower = int(beacon.split(',')[4])
-                    rssi = int(beacon.split(',')[5])
-
-                    rssi = -99 if rssi < -99 else rssi # rssi peak fix
-
-                    rssi_filtered = processor.filter(beacon_id, rssi)
-                    if rssi_filtered is None:
-                        continue
-
-                    beacon_dist = getrange(txpower, rssi_filtered)
-
-                    if const.DUMP:
-                        csv.write(str(beacon_datetime) + ',')
-                        csv.write(beacon + ',')
-                        csv.write('{:.0f}'.format(beacon_dist) + '\n')
-
-                    if beacon_dist < const.MAX_RANGE:  # maximum range
-                        beacons.add(beacon_id, beacon_datetime, beacon_dist)
+            adverts = scanner.read(const.SEND_INTERVAL)
+            now = time.time()
+            started = metrics.clock()
+            beacons.tick(now)
+            STAGE_TICK.observe(metrics.clock() - started)
+            if adverts:
+                process(adverts, now, processor, distance_model, beacons)
     except KeyboardInterrupt:
         logger.warning("Ctrl-C pressed")
-        if const.DUMP:
-            csv.close()
-        sys.exit()
+    except SystemExit:
+        logger.warning("Terminated")
+        raise
+    except:
+        logger.error("Scanner loop error", exc_info=True)
+        raise
+    finally:
+        scanner.close()
+        logger.info("adverts filter counters: %s", advert_filter.counters)
+        logger.info("adapter counters: %s", scanner.merger.counters)
+        logger.info("spool counters: %s, %s messages left", spool.counters, len(spool))
+        if recorder is not None:
+            logger.info("recorder counters: %s", recorder.counters)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+
+"""
+Event server simple client
+Waits for I-Beacons and sends messages
+Temporary stores messages in file
+
+
+MIT License
+
+Copyright (c) 2017 Roman Mindlin
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+# Client throughput benchmark on fake HCI socket, no bluetooth adapter needed
+# python benchmark.py [--beacons N] [--rate M] [--duration S] [--processors average,kalman]
+# rate 0 feeds adverts as fast as the client takes them, every processor runs in own process
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import multiprocessing
+
+import const
+
+import blescan
+import capture
+import metrics
+import beacon_client
+from beacon import Beacons
+from spool import Spool
+from distance import DistanceModel
+from replay import PROCESSORS
+from fakebluez import FakeSocket, AdvertGenerator
+
+# stage: histogram of the client pipeline
+STAGES = (('parse', capture.STAGE_PARSE),
+          ('tick', beacon_client.STAGE_TICK),
+          ('filter', beacon_client.STAGE_FILTER),
+          ('getrange', beacon_client.STAGE_GETRANGE),
+          ('add', beacon_client.STAGE_ADD))
+
+
+def run(processor, count, rate, duration, workdir):
+    """
+    Runs scanner loop of beacon_client.start() on generated adverts for duration seconds:
+    capture.LocalScanner on fake HCI socket, beacon_client.process()
+    Returns counters and total seconds spent in every stage, as observed by stage histograms
+    """
+    const.SAVE_FILE = os.path.join(workdir, 'beacons.pkl')
+    spool = Spool(os.path.join(workdir, 'spool.pkl'))
+    beacons = Beacons(spool)
+    distance_model = DistanceModel()
+    advert_filter = blescan.AdvertFilter(const.IBEACON_PREFIX, const.ALLOWED_UUID,
+                                         const.ALLOWED_MAJOR, const.ALLOWED_MINOR)
+    sock = FakeSocket()
+    blescan.hci_open_dev = lambda dev_id: sock
+    scanner = capture.LocalScanner([0], advert_filter)
+    generator = AdvertGenerator(sock.peer, count, rate)
+    generator.start()
+
+    result = {'adverts': 0}
+    memory = metrics.rss()
+    started = time.time()
+    while time.time() - started < duration:
+        adverts = scanner.read(const.SEND_INTERVAL)
+        now = time.time()
+        tick_started = metrics.clock()
+        beacons.tick(now)
+        beacon_client.STAGE_TICK.observe(metrics.clock() - tick_started)
+        if adverts:
+            beacon_client.process(adverts, now, processor, distance_model, beacons)
+            result['adverts'] += len(adverts)
+        if beacon_client.STAGE_TICK.count % 100 == 0:
+            beacons.save(timeout=0)  # keeps journal records from piling up, like saver thread does
+
+    elapsed = time.time() - started
+    generator.close()
+    scanner.close()
+    sock.close()
+    for stage, histogram in STAGES:
+        result[stage] = histogram.sum
+    result['batches'] = beacon_client.STAGE_TICK.count
+    result['elapsed'] = elapsed
+    result['memory'] = metrics.rss() - memory
+    result['sent'] = generator.sent.value
+    result['dropped'] = generator.dropped.value
+    result['visits'] = len(beacons)
+    return result
+
+
+def worker(name, count, rate, duration, queue):
+    queue.put(run(PROCESSORS[name](), count, rate, duration, tempfile.mkdtemp()))
+
+
+def report(name, result):
+    adverts = result['adverts'] or 1
+    print("{}: {:.0f} adverts/s, {} sent, {} dropped by generator, {} visits, memory +{:.1f} MB".format(
+        name, result['adverts'] / result['elapsed'], result['sent'], result['dropped'], result['visits'],
+        result['memory'] / 1048576.0))
+    print("    per advert: " + ", ".join("{} {:.1f} us".format(stage, result[stage] * 1e6 / adverts)
+                                        for stage, histogram in STAGES) +
+          ", {} batches".format(result['batches']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark client pipeline on generated adverts')
+    parser.add_argument('--beacons', type=int, default=200)
+    parser.add_argument('--rate', type=int, default=0, help='adverts per second, 0 - as fast as possible')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--processors', default='average,kalman')
+    args = parser.parse_args()
+
+    for name in args.processors.split(','):
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=worker, args=(name, args.beacons, args.rate, args.duration, queue))
+        process.start()
+        report(name, queue.get())
+        process.join()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
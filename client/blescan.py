@@ -17,13 +17,30 @@ DEBUG = False
 
 import os
 import sys
+import time
+import errno
+import select
+import socket
 import struct
-import bluetooth._bluetooth as bluez
+import binascii
+
+try:
+    import bluetooth._bluetooth as bluez
+except ImportError:
+    bluez = None  # needed only by hci_open_dev() on pythons without AF_BLUETOOTH
+
+from collections import namedtuple
 
 LE_META_EVENT = 0x3e
 LE_PUBLIC_ADDRESS=0x00
 LE_RANDOM_ADDRESS=0x01
 LE_SET_SCAN_PARAMETERS_CP_SIZE=7
+LE_SCAN_PASSIVE=0x00
+LE_SCAN_ACTIVE=0x01
+HCI_COMMAND_PKT=0x01
+HCI_EVENT_PKT=0x04
+SOL_HCI=0
+HCI_FILTER=2
 OGF_LE_CTL=0x08
 OCF_LE_SET_SCAN_PARAMETERS=0x000B
 OCF_LE_SET_SCAN_ENABLE=0x000C
@@ -45,24 +62,50 @@ ADV_SCAN_IND=0x02
 ADV_NONCONN_IND=0x03
 ADV_SCAN_RSP=0x04
 
+# HCI event header + LE meta subevent + number of reports
+EVENT_HDR = struct.Struct("<BBBBB")
+# advertisement report: event type, address type, address, data length
+REPORT_HDR = struct.Struct("<BB6sB")
+# i-beacon tail of advertising data (uuid, major, minor, txpower) followed by rssi
+IBEACON_TAIL = struct.Struct(">16sHHbb")
+IBEACON_DATA_LEN = IBEACON_TAIL.size - 1
+UINT8 = struct.Struct("<B")
+UINT16_BE = struct.Struct(">H")
+UUID = struct.Struct("16s")
+
+HCI_MAX_EVENT_SIZE = 260
+# command packet type, opcode, parameters length
+HCI_COMMAND_HDR = struct.Struct("<BHB")
+# struct hci_filter: packet type mask, event mask, opcode
+HCI_FILTER_STRUCT = struct.Struct("=IIIH")
+# event packets, all events, same as bluez hci_filter_set_ptype() + hci_filter_all_events()
+EVENT_FILTER = HCI_FILTER_STRUCT.pack(1 << HCI_EVENT_PKT, 0xffffffff, 0xffffffff, 0)
+
 
-def returnnumberpacket(pkt):
-    myInteger = 0
-    multiple = 256
-    for c in pkt:
-        myInteger +=  struct.unpack("B",c)[0] * multiple
-        multiple = 1
-    return myInteger
+class Advert(namedtuple('Advert', 'mac uuid major minor txpower rssi')):
+    """
+    Decoded i-beacon advertisement
+    mac and uuid are kept as raw packet bytes, everything else is int
+    """
+    __slots__ = ()
+
+    @property
+    def address(self):
+        return packed_bdaddr_to_string(self.mac)
+
+    @property
+    def uuid_hex(self):
+        return binascii.hexlify(self.uuid).decode('ascii')
+
+    def __str__(self):
+        "Old comma-joined format: mac,uuid,major,minor,txpower,rssi"
+        return "%s,%s,%i,%i,%i,%i" % (self.address, self.uuid_hex, self.major,
+                                      self.minor, self.txpower, self.rssi)
 
-def returnstringpacket(pkt):
-    myString = "";
-    for c in pkt:
-        myString +=  "%02x" %struct.unpack("B",c)[0]
-    return myString
 
 def printpacket(pkt):
-    for c in pkt:
-        sys.stdout.write("%02x " % struct.unpack("B",c)[0])
+    for c in bytearray(pkt):
+        sys.stdout.write("%02x " % c)
 
 def get_packed_bdaddr(bdaddr_string):
     packable_addr = []
@@ -75,13 +118,31 @@ def get_packed_bdaddr(bdaddr_string):
 def packed_bdaddr_to_string(bdaddr_packed):
     return ':'.join('%02x'%i for i in struct.unpack("<BBBBBB", bdaddr_packed[::-1]))
 
-def hci_enable_le_scan(sock):
-    hci_toggle_le_scan(sock, 0x01)
+def hci_open_dev(dev_id):
+    """
+    Opens raw HCI socket of device
+    Native socket is used when Python has AF_BLUETOOTH, it supports recv_into(), PyBluez one does not
+    """
+    if hasattr(socket, 'BTPROTO_HCI'):
+        sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_RAW, socket.BTPROTO_HCI)
+        sock.bind((dev_id,))
+        return sock
+    if bluez is None:
+        raise IOError("No AF_BLUETOOTH in this python, PyBluez is needed to open hci%d" % dev_id)
+    return bluez.hci_open_dev(dev_id)
+
+def hci_send_cmd(sock, ogf, ocf, params):
+    "Writes HCI command packet to socket, same as bluez hci_send_cmd()"
+    opcode = (ogf << 10) | ocf
+    sock.send(HCI_COMMAND_HDR.pack(HCI_COMMAND_PKT, opcode, len(params)) + params)
+
+def hci_enable_le_scan(sock, filter_dup=False):
+    hci_toggle_le_scan(sock, 0x01, filter_dup)
 
 def hci_disable_le_scan(sock):
     hci_toggle_le_scan(sock, 0x00)
 
-def hci_toggle_le_scan(sock, enable):
+def hci_toggle_le_scan(sock, enable, filter_dup=False):
 # hci_le_set_scan_enable(dd, 0x01, filter_dup, 1000);
 # memset(&scan_cp, 0, sizeof(scan_cp));
  #uint8_t         enable;
@@ -99,83 +160,196 @@ def hci_toggle_le_scan(sock, enable):
 
 #        if (hci_send_req(dd, &rq, to) < 0)
 #                return -1;
-    cmd_pkt = struct.pack("<BB", enable, 0x00)
-    bluez.hci_send_cmd(sock, OGF_LE_CTL, OCF_LE_SET_SCAN_ENABLE, cmd_pkt)
+    cmd_pkt = struct.pack("<BB", enable, 0x01 if filter_dup else 0x00)
+    hci_send_cmd(sock, OGF_LE_CTL, OCF_LE_SET_SCAN_ENABLE, cmd_pkt)
 
 
-def hci_le_set_scan_parameters(sock):
-    old_filter = sock.getsockopt( bluez.SOL_HCI, bluez.HCI_FILTER, 14)
+def hci_le_set_scan_parameters(sock, scan_type=LE_SCAN_PASSIVE, interval=0x0010, window=0x0010,
+                               own_type=LE_PUBLIC_ADDRESS, filter_policy=0x00):
+    """
+    Sends LE Set Scan Parameters command, scanning must be disabled
+    interval and window are in 0.625 ms units, 0x0004..0x4000, window <= interval
+    """
+    if not 0x0004 <= window <= interval <= 0x4000:
+        raise ValueError("bad scan interval/window: 0x%04x/0x%04x" % (interval, window))
+    cmd_pkt = struct.pack("<BHHBB", scan_type, interval, window, own_type, filter_policy)
+    hci_send_cmd(sock, OGF_LE_CTL, OCF_LE_SET_SCAN_PARAMETERS, cmd_pkt)
 
-    SCAN_RANDOM = 0x01
-    OWN_TYPE = SCAN_RANDOM
-    SCAN_TYPE = 0x01
 
+class AdvertFilter(object):
+    """
+    Allowlist for advertising reports, checked on raw report bytes before decoding
+    Empty uuids/majors/minors means any value is allowed
+    counters keep number of reports dropped at every stage
+    """
 
+    def __init__(self, prefix, uuids=(), majors=(), minors=()):
+        self.prefix = binascii.unhexlify(prefix)
+        self.uuids = frozenset(binascii.unhexlify(uuid) for uuid in uuids)
+        self.majors = frozenset(int(major) for major in majors)
+        self.minors = frozenset(int(minor) for minor in minors)
+        self.min_len = IBEACON_DATA_LEN + len(self.prefix)
+        self.counters = dict.fromkeys(('short', 'prefix', 'uuid', 'major', 'minor', 'accepted'), 0)
 
-def parse_events(sock, loop_count=100):
-    old_filter = sock.getsockopt( bluez.SOL_HCI, bluez.HCI_FILTER, 14)
-
-    # perform a device inquiry on bluetooth device #0
-    # The inquiry should last 8 * 1.28 = 10.24 seconds
-    # before the inquiry is performed, bluez should flush its cache of
-    # previously discovered devices
-    flt = bluez.hci_filter_new()
-    bluez.hci_filter_all_events(flt)
-    bluez.hci_filter_set_ptype(flt, bluez.HCI_EVENT_PKT)
-    sock.setsockopt( bluez.SOL_HCI, bluez.HCI_FILTER, flt )
-    done = False
-    results = []
-    myFullList = []
+    def accept(self, pkt, data_len, data_end):
+        "Checks report data ending at data_end (the rssi byte)"
+        tail = data_end - IBEACON_DATA_LEN
+        if data_len < self.min_len:
+            self.counters['short'] += 1
+            return False
+        if pkt[tail - len(self.prefix):tail] != self.prefix:
+            self.counters['prefix'] += 1
+            return False
+        if self.majors and UINT16_BE.unpack_from(pkt, tail + 16)[0] not in self.majors:
+            self.counters['major'] += 1
+            return False
+        if self.minors and UINT16_BE.unpack_from(pkt, tail + 18)[0] not in self.minors:
+            self.counters['minor'] += 1
+            return False
+        if self.uuids and UUID.unpack_from(pkt, tail)[0] not in self.uuids:
+            self.counters['uuid'] += 1
+            return False
+        self.counters['accepted'] += 1
+        return True
+
+
+def parse_packet(pkt, length=None, adverts=None, advert_filter=None):
+    """
+    Decodes LE advertising reports of one raw HCI event packet into Advert records
+    pkt may be any buffer (bytes, bytearray, memoryview), nothing is copied but the fields itself
+    Reports rejected by advert_filter are skipped without decoding
+    """
+    if adverts is None:
+        adverts = []
+    if length is None:
+        length = len(pkt)
+    if length < EVENT_HDR.size:
+        return adverts
+
+    ptype, event, plen, subevent, num_reports = EVENT_HDR.unpack_from(pkt, 0)
+    if event != LE_META_EVENT or subevent != EVT_LE_ADVERTISING_REPORT:
+        return adverts
+
+    offset = EVENT_HDR.size
+    for i in range(0, num_reports):
+        if offset + REPORT_HDR.size > length:
+            break
+        data_len, = UINT8.unpack_from(pkt, offset + REPORT_HDR.size - 1)
+        data_end = offset + REPORT_HDR.size + data_len
+        if data_end >= length:  # rssi byte follows the data
+            break
+        if advert_filter is None:
+            accepted = data_len >= IBEACON_DATA_LEN
+        else:
+            accepted = advert_filter.accept(pkt, data_len, data_end)
+        if accepted:
+            evt_type, addr_type, mac, data_len = REPORT_HDR.unpack_from(pkt, offset)
+            uuid, major, minor, txpower, rssi = IBEACON_TAIL.unpack_from(pkt, data_end - IBEACON_DATA_LEN)
+            advert = Advert(mac, uuid, major, minor, txpower, rssi)
+            if DEBUG:
+                sys.stdout.write("-------------\n\tAdvert: %s\n" % (advert,))
+            adverts.append(advert)
+        offset = data_end + 1
+    return adverts
+
+
+def parse_adverts(sock, loop_count=100):
+    "Reads loop_count packets from socket, returns list of Advert records"
+    old_filter = sock.getsockopt( SOL_HCI, HCI_FILTER, HCI_FILTER_STRUCT.size)
+    sock.setsockopt( SOL_HCI, HCI_FILTER, EVENT_FILTER )
+
+    adverts = []
     for i in range(0, loop_count):
         pkt = sock.recv(255)
-        ptype, event, plen = struct.unpack("BBB", pkt[:3])
-        #print "--------------"
-        if event == bluez.EVT_INQUIRY_RESULT_WITH_RSSI:
-            i =0
-        elif event == bluez.EVT_NUM_COMP_PKTS:
-            i =0
-        elif event == bluez.EVT_DISCONN_COMPLETE:
-            i =0
-        elif event == LE_META_EVENT:
-            subevent, = struct.unpack("B", pkt[3])
-            pkt = pkt[4:]
-            if subevent == EVT_LE_CONN_COMPLETE:
-                le_handle_connection_complete(pkt)
-            elif subevent == EVT_LE_ADVERTISING_REPORT:
-                #print "advertising report"
-                num_reports = struct.unpack("B", pkt[0])[0]
-                report_pkt_offset = 0
-                for i in range(0, num_reports):
-
-                    if (DEBUG == True):
-                        print "-------------"
-                        #print "\tfullpacket: ", printpacket(pkt)
-                        print "\tUDID: ", printpacket(pkt[report_pkt_offset -22: report_pkt_offset - 6])
-                        print "\tMAJOR: ", printpacket(pkt[report_pkt_offset -6: report_pkt_offset - 4])
-                        print "\tMINOR: ", printpacket(pkt[report_pkt_offset -4: report_pkt_offset - 2])
-                        print "\tMAC address: ", packed_bdaddr_to_string(pkt[report_pkt_offset + 3:report_pkt_offset + 9])
-                        # commented out - don't know what this byte is.  It's NOT TXPower
-                        txpower, = struct.unpack("b", pkt[report_pkt_offset -2])
-                        print "\t(Unknown):", txpower
-
-                        rssi, = struct.unpack("b", pkt[report_pkt_offset -1])
-                        print "\tRSSI:", rssi
-                    # build the return string
-                    Adstring = packed_bdaddr_to_string(pkt[report_pkt_offset + 3:report_pkt_offset + 9])
-                    Adstring += ","
-                    Adstring += returnstringpacket(pkt[report_pkt_offset -22: report_pkt_offset - 6])
-                    Adstring += ","
-                    Adstring += "%i" % returnnumberpacket(pkt[report_pkt_offset -6: report_pkt_offset - 4])
-                    Adstring += ","
-                    Adstring += "%i" % returnnumberpacket(pkt[report_pkt_offset -4: report_pkt_offset - 2])
-                    Adstring += ","
-                    Adstring += "%i" % struct.unpack("b", pkt[report_pkt_offset -2])
-                    Adstring += ","
-                    Adstring += "%i" % struct.unpack("b", pkt[report_pkt_offset -1])
-
-                    #print "\tAdstring=", Adstring
-                    myFullList.append(Adstring)
-                done = True
-    sock.setsockopt( bluez.SOL_HCI, bluez.HCI_FILTER, old_filter )
-    return myFullList
+        parse_packet(pkt, adverts=adverts)
+    sock.setsockopt( SOL_HCI, HCI_FILTER, old_filter )
+    return adverts
+
+
+def parse_events(sock, loop_count=100):
+    "Old interface, returns list of 'mac,uuid,major,minor,txpower,rssi' strings"
+    return [str(advert) for advert in parse_adverts(sock, loop_count)]
+
+
+class Scanner(object):
+    """
+    Long-lived HCI reader
+    Installs the event filter once and keeps it until close(),
+    every read() drains all pending packets through one preallocated buffer,
+    sockets without recv_into() (PyBluez ones) cost one bytes object per packet
+    With controller duplicate filtering scan is re-enabled every rearm_interval seconds,
+    otherwise each beacon is reported only once
+    """
+
+    def __init__(self, sock, advert_filter=None, filter_dup=False, rearm_interval=0, max_packets=256):
+        self.sock = sock
+        self.advert_filter = advert_filter
+        self.filter_dup = filter_dup
+        self.rearm_interval = rearm_interval if filter_dup else 0
+        self.rearm_at = time.time() + self.rearm_interval
+        self.max_packets = max_packets
+        self.buffer = bytearray(HCI_MAX_EVENT_SIZE)
+        self.view = memoryview(self.buffer)
+
+        self.old_filter = sock.getsockopt( SOL_HCI, HCI_FILTER, HCI_FILTER_STRUCT.size)
+        sock.setsockopt( SOL_HCI, HCI_FILTER, EVENT_FILTER )
+        sock.setblocking(False)
+
+    def recv(self):
+        "Reads one pending packet into buffer, returns its length or 0 if nothing is pending"
+        try:
+            if hasattr(self.sock, 'recv_into'):
+                return self.sock.recv_into(self.view, HCI_MAX_EVENT_SIZE)
+            pkt = self.sock.recv(HCI_MAX_EVENT_SIZE)
+            self.view[:len(pkt)] = pkt
+            return len(pkt)
+        except (IOError, OSError) as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return 0
+            raise
+
+    def rearm(self):
+        "Restarts scan to reset controller duplicate filter"
+        hci_disable_le_scan(self.sock)
+        hci_enable_le_scan(self.sock, self.filter_dup)
+        self.rearm_at = time.time() + self.rearm_interval
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def timeout(self, timeout=None):
+        "Re-arms scan when it is due, returns timeout shortened to the next re-arm"
+        if self.rearm_interval:
+            rearm_timeout = self.rearm_at - time.time()
+            if rearm_timeout <= 0:
+                self.rearm()
+                rearm_timeout = self.rearm_interval
+            if timeout is None or rearm_timeout < timeout:
+                timeout = rearm_timeout
+        return timeout
+
+    def wait(self, timeout=None):
+        "Waits up to timeout seconds for packets, re-arms scan when it is due, returns True if any are pending"
+        ready, _, _ = select.select([self.sock], [], [], self.timeout(timeout))
+        return bool(ready)
+
+    def drain(self, adverts):
+        "Parses pending packets into adverts list, at most max_packets of them"
+        for i in range(0, self.max_packets):
+            length = self.recv()
+            if not length:
+                break
+            parse_packet(self.view, length, adverts, self.advert_filter)
+        return adverts
+
+    def read(self, timeout=None):
+        "Waits up to timeout seconds for packets, returns Advert records of all pending ones"
+        adverts = []
+        if self.wait(timeout):
+            self.drain(adverts)
+        return adverts
 
+    def close(self):
+        "Restores original socket filter"
+        self.sock.setblocking(True)
+        self.sock.setsockopt( SOL_HCI, HCI_FILTER, self.old_filter )
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+
+"""
+Event server simple client
+Waits for I-Beacons and sends messages
+Temporary stores messages in file
+
+
+MIT License
+
+Copyright (c) 2017 Roman Mindlin
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import time
+import heapq
+import select
+import multiprocessing
+
+from collections import namedtuple
+
+
+import blescan
+import const
+import logger
+import metrics
+from logger import stop as logger_stop
+from ringbuffer import RingBuffer
+
+logger = logger.get_logger(__name__)
+
+# capture times are monotonic, the same clock in all processes
+clock = getattr(time, 'monotonic', time.time)
+
+STAGE_PARSE = metrics.histogram('beacon_stage_seconds', 'Processing time of one batch by stage', stage='parse')
+ADAPTER_HELP = {'reports': 'Adverts heard by adapter', 'duplicates': 'Adverts heard by other adapter first'}
+
+
+def open_device(dev_id):
+    "Opens HCI device and starts LE scan with parameters from const"
+    sock = blescan.hci_open_dev(dev_id)
+    blescan.hci_disable_le_scan(sock)
+    blescan.hci_le_set_scan_parameters(sock,
+                                       blescan.LE_SCAN_ACTIVE if const.SCAN_ACTIVE else blescan.LE_SCAN_PASSIVE,
+                                       const.SCAN_INTERVAL, const.SCAN_WINDOW,
+                                       blescan.LE_RANDOM_ADDRESS if const.SCAN_RANDOM_ADDRESS else blescan.LE_PUBLIC_ADDRESS)
+    blescan.hci_enable_le_scan(sock, const.FILTER_DUPLICATES)
+    return sock
+
+
+def capture(dev_id, ring, stop):
+    "Capture process: copies raw HCI frames to ring buffer, nothing else"
+    try:
+        sock = open_device(dev_id)
+    except:
+        logger.error('Error accessing bluetooth device', exc_info=True)
+        logger_stop()
+        return
+    scanner = blescan.Scanner(sock, None, const.FILTER_DUPLICATES, const.FILTER_DUPLICATES_REARM)
+    logger.info("capture process started")
+    try:
+        while not stop.is_set():
+            if scanner.wait(const.SEND_INTERVAL):
+                for i in range(0, scanner.max_packets):
+                    length = scanner.recv()
+                    if not length:
+                        break
+                    ring.put(scanner.view, length, clock())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        scanner.close()
+        ring.close()
+        logger_stop()
+
+
+class Report(namedtuple('Report', blescan.Advert._fields + ('time', 'adapters'))):
+    """
+    Advert merged from all adapters: the strongest rssi, monotonic capture time of the first report,
+    adapters = ((dev_id, rssi), ...) of every adapter which has heard it
+    """
+    __slots__ = ()
+
+    def __str__(self):
+        return str(blescan.Advert(*self[:6]))
+
+
+class Merger(object):
+    """
+    Merges adverts from several adapters into one time ordered stream of Reports
+    Same beacon heard by other adapters within window seconds is the same advertisement,
+    it makes one Report. Reports are held back for window seconds to wait for other adapters
+    """
+
+    def __init__(self, devices, window=const.MERGE_WINDOW):
+        self.window = window if len(devices) > 1 else 0
+        self.pending = {}  # identity: [time, advert, {dev_id: rssi}] not yet released
+        self.heap = []  # (time, seq, group)
+        self.seq = 0
+        self.counters = {}
+        for dev_id in devices:
+            self.adapter(dev_id)
+
+    def adapter(self, dev_id):
+        "Returns counters of adapter"
+        counters = self.counters.get(dev_id)
+        if counters is None:
+            counters = self.counters[dev_id] = {'reports': 0, 'rssi_sum': 0, 'duplicates': 0}
+        return counters
+
+    def add(self, dev_id, now, adverts):
+        "Adds adverts captured by adapter at now"
+        counters = self.adapter(dev_id)
+        counters['reports'] += len(adverts)
+        for advert in adverts:
+            counters['rssi_sum'] += advert.rssi
+            identity = advert[:4]
+            group = self.pending.get(identity)
+            if group is not None and dev_id not in group[2] and now - group[0] <= self.window:
+                group[2][dev_id] = advert.rssi
+                if advert.rssi > group[1].rssi:
+                    group[1] = advert
+                counters['duplicates'] += 1
+            else:
+                group = [now, advert, {dev_id: advert.rssi}]
+                self.pending[identity] = group
+                heapq.heappush(self.heap, (now, self.seq, group))
+                self.seq += 1
+
+    def due(self):
+        "Time when the next held Report is released or None"
+        return self.heap[0][0] + self.window if self.heap else None
+
+    def pop(self, now):
+        "Returns time ordered Reports captured more than window seconds ago"
+        reports = []
+        while self.heap and self.heap[0][0] + self.window <= now:
+            captured, seq, group = heapq.heappop(self.heap)
+            identity = group[1][:4]
+            if self.pending.get(identity) is group:
+                del self.pending[identity]
+            reports.append(Report(*(tuple(group[1]) + (captured, tuple(sorted(group[2].items()))))))
+        return reports
+
+
+class MergedScanner(object):
+    """
+    Reads adverts of several adapters as one stream of Reports, same interface as blescan.Scanner
+    Subclasses collect() captured frames with frame(), raw frames are written to recorder if there is one
+    """
+
+    def __init__(self, devices, advert_filter=None, recorder=None):
+        self.devices = devices
+        self.advert_filter = advert_filter
+        self.recorder = recorder
+        self.merger = Merger(devices)
+        self.stats = dict((dev_id, dict(counters)) for dev_id, counters in self.merger.counters.items())
+        self.stats_at = clock()
+        for dev_id, counters in self.merger.counters.items():
+            for key in ('reports', 'duplicates'):
+                metrics.gauge('beacon_adapter_' + key + '_total', lambda counters=counters, key=key: counters[key],
+                              ADAPTER_HELP[key], adapter='hci{}'.format(dev_id))
+
+    def frame(self, dev_id, now, frame, length):
+        "Parses frame captured by adapter at now into merger"
+        if self.recorder is not None:
+            self.recorder.write(now, dev_id, frame, length)
+        self.merger.add(dev_id, now, blescan.parse_packet(frame, length, None, self.advert_filter))
+
+    def read(self, timeout=None):
+        "Waits up to timeout seconds for adverts, returns released Reports"
+        due = self.merger.due()
+        if due is not None:
+            due = max(0, due - clock())
+            if timeout is None or due < timeout:
+                timeout = due
+        self.collect(timeout)
+        now = clock()
+        if now - self.stats_at >= const.ADAPTER_STATS_INTERVAL:
+            self.log_stats(now)
+        return self.merger.pop(now)
+
+    def log_stats(self, now):
+        "Logs per-adapter rates since previous call"
+        for dev_id in self.devices:
+            counters, last = self.merger.counters[dev_id], self.stats[dev_id]
+            reports = counters['reports'] - last['reports']
+            logger.info("hci%s: %.1f reports/s, mean rssi %.1f, %s duplicates",
+                        dev_id, reports / (now - self.stats_at),
+                        float(counters['rssi_sum'] - last['rssi_sum']) / reports if reports else 0,
+                        counters['duplicates'] - last['duplicates'])
+            self.stats[dev_id] = dict(counters)
+        self.stats_at = now
+
+
+class LocalScanner(MergedScanner):
+    "Captures all adapters in this process, one Scanner each, waiting on all of them at once"
+
+    def __init__(self, devices, advert_filter=None, recorder=None):
+        MergedScanner.__init__(self, devices, advert_filter, recorder)
+        self.scanners = {}
+        for dev_id in devices:
+            scanner = blescan.Scanner(open_device(dev_id), None,
+                                      const.FILTER_DUPLICATES, const.FILTER_DUPLICATES_REARM)
+            self.scanners[scanner] = dev_id
+
+    def collect(self, timeout):
+        for scanner in self.scanners:
+            timeout = scanner.timeout(timeout)
+        ready, _, _ = select.select(list(self.scanners), [], [], timeout)
+        now = clock()
+        started = metrics.clock()
+        for scanner in ready:
+            dev_id = self.scanners[scanner]
+            for i in range(0, scanner.max_packets):
+                length = scanner.recv()
+                if not length:
+                    break
+                self.frame(dev_id, now, scanner.view, length)
+        if ready:
+            STAGE_PARSE.observe(metrics.clock() - started)
+
+    def close(self):
+        "Restores original socket filters"
+        for scanner in self.scanners:
+            scanner.close()
+        if self.recorder is not None:
+            self.recorder.close()
+
+
+class RingScanner(MergedScanner):
+    """
+    Reads adverts captured by separate processes, one per adapter, each with own ring buffer
+    Capture is independent of processing hiccups, frames are parsed here in batches
+    """
+
+    def __init__(self, devices, advert_filter=None, recorder=None, max_packets=const.RING_SLOTS):
+        MergedScanner.__init__(self, devices, advert_filter, recorder)
+        self.max_packets = max_packets
+        self.stop = multiprocessing.Event()
+        self.rings = {}
+        self.processes = []
+        self.dropped = dict.fromkeys(devices, 0)
+        for dev_id in devices:
+            ring = RingBuffer()
+            process = multiprocessing.Process(target=capture, args=(dev_id, ring, self.stop))
+            process.daemon = True
+            process.start()
+            self.rings[dev_id] = ring
+            self.processes.append(process)
+            metrics.gauge('beacon_ring_dropped_total', lambda ring=ring: ring.dropped,
+                          'Frames dropped on full ring buffer', adapter='hci{}'.format(dev_id))
+
+    def collect(self, timeout):
+        deadline = clock() + (const.SEND_INTERVAL if timeout is None else timeout)
+        while not any(len(ring) for ring in self.rings.values()):
+            if not all(process.is_alive() for process in self.processes):
+                raise RuntimeError('capture process exited')
+            left = deadline - clock()
+            if left <= 0:
+                return
+            time.sleep(min(left, const.RING_POLL_INTERVAL))
+
+        started = metrics.clock()
+        for dev_id, ring in self.rings.items():
+            for now, frame, length in ring.frames(self.max_packets):
+                self.frame(dev_id, now, frame, length)
+            dropped = ring.dropped
+            if dropped != self.dropped[dev_id]:
+                logger.warning("hci%s ring buffer full, %s frames dropped", dev_id, dropped - self.dropped[dev_id])
+                self.dropped[dev_id] = dropped
+        STAGE_PARSE.observe(metrics.clock() - started)
+
+    def close(self):
+        "Stops capture processes, frees shared memory"
+        self.stop.set()
+        for process in self.processes:
+            process.join(2 * const.SEND_INTERVAL)
+        for ring in self.rings.values():
+            ring.close()
+            ring.unlink()
+        if self.recorder is not None:
+            self.recorder.close()
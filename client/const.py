@@ -2,12 +2,78 @@
 
 SERVER_URL = 'http://192.168.43.43/api/messages/'
 # SERVER_URL = 'http://10.0.100.102/api/messages/'
+SERVER_BATCH_URL = SERVER_URL + 'batch'
+SEND_TIMEOUT = 5
+BATCH_SIZE = 100  # max messages in one request
+BATCH_MAX_AGE = 1  # seconds to wait for more messages before sending not full batch
 TIMEOUT = 10
+SEND_INTERVAL = 0.5  # seconds between checks for ready-to-send beacons
 SAVE_TIMEOUT = 10
 MAX_RANGE = 15
 TIME_SYNC = False
 RTC = True
-DUMP = False
+DUMP = False  # record raw HCI frames to CAPTURE_FILE, see replay.py
+# Allowed i-beacons, checked on raw packets. Empty list - any value
+IBEACON_PREFIX = '1aff4c000215'  # manufacturer data header, Apple company id, i-beacon type and length
+ALLOWED_UUID = []
 ALLOWED_MAJOR = ['1', ]
+ALLOWED_MINOR = []
+# LE scan parameters, interval and window in 0.625 ms units
+SCAN_ACTIVE = False
+SCAN_INTERVAL = 0x0010
+SCAN_WINDOW = 0x0010
+SCAN_RANDOM_ADDRESS = False
+# HCI adapters to scan with, reports of the same advertisement heard by several adapters
+# within MERGE_WINDOW seconds are merged
+HCI_DEVICES = [0, ]
+MERGE_WINDOW = 0.05
+ADAPTER_STATS_INTERVAL = 60  # seconds between per-adapter rate log lines
+# Capture HCI frames in separate processes, handed over through shared memory ring buffer (python 3.8+)
+CAPTURE_PROCESS = False
+RING_SLOTS = 4096  # frames
+RING_POLL_INTERVAL = 0.005  # seconds between checks of empty ring buffer
+# Controller duplicate filtering, scan is restarted every FILTER_DUPLICATES_REARM seconds
+FILTER_DUPLICATES = False
+FILTER_DUPLICATES_REARM = 1.0
+# Kalman filter parameters, KALMAN_WINDOW is used by old windowed implementation only
+KALMAN_Q = 1e-6
+KALMAN_R = 0.1 ** 3
+KALMAN_X0 = -40.0
+KALMAN_P0 = 1.0
+KALMAN_WINDOW = 30
+# Filter state limits: max number of beacons, seconds to keep not seen beacon
+FILTER_MAX_BEACONS = 5000
+FILTER_TTL = 60
+# Per beacon model distance calibration, see distance.DistanceModel
+CALIBRATION_FILE = '/home/pi/client/calibration.json'
 SAVE_FILE = '/home/pi/client/beacons.pkl'
-LOG_FILE = '/home/pi/client/beacon_client.log'
\ No newline at end of file
+JOURNAL_MAX_SIZE = 1024 * 1024  # bytes of journal before snapshot compaction
+# Outbound messages spool, oldest messages are dropped when it is full
+SPOOL_FILE = '/home/pi/client/spool.pkl'
+SPOOL_MAX_ITEMS = 100000
+# Server failures: breaker opens after BREAKER_THRESHOLD failures in a row,
+# then retries with random delay up to BACKOFF_BASE * 2^n, at most BACKOFF_MAX seconds
+BREAKER_THRESHOLD = 3
+BACKOFF_BASE = 1
+BACKOFF_MAX = 300
+# Capture recorder, files are rotated at CAPTURE_MAX_SIZE bytes, CAPTURE_KEEP old ones are kept
+CAPTURE_FILE = '/home/pi/client/capture.bin'
+CAPTURE_MAX_SIZE = 10 * 1024 * 1024
+CAPTURE_KEEP = 5
+CAPTURE_COMPRESS = True
+# Runtime metrics: /metrics HTTP endpoint on METRICS_HOST:METRICS_PORT (0 - off)
+# and/or JSON stats file written every SAVE_TIMEOUT seconds (None - off)
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 0  # e.g. 9200, not 9100: node_exporter listens there on most Pis
+METRICS_FILE = None
+# Sampling profiler, started by SIGUSR1 or by creating PROFILE_TRIGGER file (it may hold seconds),
+# writes profile-*.folded next to LOG_FILE
+PROFILE_TRIGGER = '/home/pi/client/profile'
+PROFILE_DURATION = 30
+PROFILE_INTERVAL = 0.005
+# Log is written by one thread, rotated at LOG_MAX_SIZE bytes with LOG_BACKUPS old files kept
+LOG_FILE = '/home/pi/client/beacon_client.log'
+LOG_MAX_SIZE = 1024 * 1024
+LOG_BACKUPS = 3
+LOG_QUEUE_SIZE = 10000  # records waiting for writer thread, more are dropped
+LOG_BEACON_INTERVAL = 10  # seconds between messages about the same beacon
\ No newline at end of file
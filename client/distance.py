@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+
+"""
+Event server simple client
+Waits for I-Beacons and sends messages
+Temporary stores messages in file
+
+
+MIT License
+
+Copyright (c) 2017 Roman Mindlin
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import os
+import json
+import math
+import binascii
+
+import const
+import logger
+
+logger = logger.get_logger(__name__)
+
+MIN_RSSI = -99
+MAX_RSSI = 0
+RSSI_RANGE = MAX_RSSI - MIN_RSSI + 1
+TXPOWER_RANGE = 256  # txpower is int8
+MAX_DISTANCE = 2 ** 31 - 1  # nonsense txpower values give huge distances, keep table in int32
+
+# distance = a * ratio ^ b + c
+DEFAULT_COEFFICIENTS = (0.89976, 7.7095, 0.111)
+
+
+def calc_distance(txPower, rssi, a, b, c):
+    "https://stackoverflow.com/questions/20416218/understanding-ibeacon-distancing"
+    if txPower == 0:
+        txPower = 1
+    ratio = float(rssi) / txPower
+    if (ratio < 1.0):
+        return int(round(math.pow(ratio, 10)))
+    else:
+        distance = a * math.pow(ratio, b) + c
+    return int(round(distance))
+
+
+def build_table(coefficients):
+    "Returns distances for all txpower and rssi values, indexed by table_index()"
+    table = [0] * (TXPOWER_RANGE * RSSI_RANGE)
+    for txpower in range(-128, 128):
+        for rssi in range(MIN_RSSI, MAX_RSSI + 1):
+            table[table_index(txpower, rssi)] = min(calc_distance(txpower, rssi, *coefficients), MAX_DISTANCE)
+    return table
+
+
+def table_index(txpower, rssi):
+    rssi = MIN_RSSI if rssi < MIN_RSSI else MAX_RSSI if rssi > MAX_RSSI else rssi
+    return (txpower & 0xff) * RSSI_RANGE + rssi - MIN_RSSI
+
+
+class DistanceModel(object):
+    """
+    Precalculated (txpower, rssi) -> distance tables
+    Beacon models with calibration get own table, keyed by (uuid, major) or (uuid, None) for all majors
+
+    Calibration file is json list of
+    {"uuid": "<hex>", "major": 1, "coefficients": [a, b, c], "txpower": -59}
+    major, coefficients and txpower (measured power at 1 m, replaces advertised one) are optional
+    """
+
+    def __init__(self, calibration_file=const.CALIBRATION_FILE):
+        self.tables = {DEFAULT_COEFFICIENTS: build_table(DEFAULT_COEFFICIENTS)}
+        self.default = self.tables[DEFAULT_COEFFICIENTS]
+        self.calibration = {}  # (uuid, major): (table, txpower)
+        if calibration_file:
+            self.load(calibration_file)
+
+    def load(self, path):
+        "Loads calibration file"
+        if not os.path.exists(path):
+            logger.info("No calibration file %s", path)
+            return
+        try:
+            with open(path) as f:
+                for item in json.load(f):
+                    coefficients = tuple(item.get('coefficients', DEFAULT_COEFFICIENTS))
+                    if coefficients not in self.tables:
+                        self.tables[coefficients] = build_table(coefficients)
+                    key = (binascii.unhexlify(item['uuid']), item.get('major'))
+                    self.calibration[key] = (self.tables[coefficients], item.get('txpower'))
+            logger.info("%s calibration records loaded", len(self.calibration))
+        except:
+            logger.error("Cannot load calibration file %s", path, exc_info=True)
+
+    def getrange(self, txpower, rssi, uuid=None, major=None):
+        "Returns distance for beacon, uuid (raw bytes) and major select calibration"
+        table = self.default
+        if self.calibration:
+            calibration = self.calibration.get((uuid, major)) or self.calibration.get((uuid, None))
+            if calibration is not None:
+                table, measured_power = calibration
+                if measured_power is not None:
+                    txpower = measured_power
+        rssi = MIN_RSSI if rssi < MIN_RSSI else MAX_RSSI if rssi > MAX_RSSI else rssi
+        return table[(txpower & 0xff) * RSSI_RANGE + rssi - MIN_RSSI]
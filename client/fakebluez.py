@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+"""
+Event server simple client
+Waits for I-Beacons and sends messages
+Temporary stores messages in file
+
+
+MIT License
+
+Copyright (c) 2017 Roman Mindlin
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+# Fake HCI socket for tests and benchmarks without bluetooth hardware:
+# FakeSocket takes the place of bluez.hci_open_dev() socket, AdvertGenerator feeds it
+# with LE advertising report frames of i-beacons
+
+import math
+import time
+import errno
+import random
+import socket
+import struct
+import threading
+import multiprocessing
+
+import blescan
+
+# iBeacon advertising data: flags, manufacturer specific data header, uuid, major, minor, txpower
+IBEACON_DATA = struct.Struct('>3s6s16sHHb')
+FLAGS = b'\x02\x01\x06'
+PREFIX = b'\x1a\xff\x4c\x00\x02\x15'
+
+
+def advert_frame(mac, uuid, major, minor, txpower, rssi):
+    "Returns HCI event packet with one LE advertising report"
+    data = IBEACON_DATA.pack(FLAGS, PREFIX, uuid, major, minor, txpower)
+    report = blescan.REPORT_HDR.pack(0x03, 0x00, mac, len(data)) + data + struct.pack('b', rssi)
+    return blescan.EVENT_HDR.pack(0x04, blescan.LE_META_EVENT, len(report) + 2,
+                                  blescan.EVT_LE_ADVERTISING_REPORT, 1) + report
+
+
+class FakeSocket(object):
+    """
+    Stands for HCI socket: frames written to peer end are read by Scanner,
+    HCI commands sent to it are recorded in commands as (ogf, ocf, params)
+    """
+
+    def __init__(self):
+        self.sock, self.peer = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.hci_filter = bytes(bytearray(14))
+        self.commands = []
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def setblocking(self, flag):
+        self.sock.setblocking(flag)
+
+    def recv(self, size):
+        return self.sock.recv(size)
+
+    def recv_into(self, buffer, size):
+        return self.sock.recv_into(buffer, size)
+
+    def getsockopt(self, level, name, size):
+        return self.hci_filter
+
+    def setsockopt(self, level, name, value):
+        self.hci_filter = value
+
+    def send(self, data):
+        ptype, opcode, plen = blescan.HCI_COMMAND_HDR.unpack_from(data)
+        start = blescan.HCI_COMMAND_HDR.size
+        self.commands.append((opcode >> 10, opcode & 0x3ff, bytes(data[start:start + plen])))
+        return len(data)
+
+    def close(self):
+        self.sock.close()
+        self.peer.close()
+
+
+class AdvertGenerator(object):
+    """
+    Writes advert frames of count beacons to socket at rate frames per second, 0 - as fast as possible
+    Beacons are at random distances, rssi follows log-distance path loss with gaussian noise of sigma dB
+    Frames which do not fit into socket buffer are dropped and counted, as controller would do
+    """
+
+    def __init__(self, sock, count=100, rate=1000, sigma=4.0, exponent=2.0, major=1, seed=None):
+        self.sock = sock
+        self.rate = rate
+        self.sigma = sigma
+        self.random = random.Random(seed)
+        uuid = bytes(bytearray(self.random.getrandbits(8) for i in range(16)))
+        self.beacons = []  # (mac, uuid, major, minor, txpower, mean rssi)
+        for minor in range(count):
+            mac = bytes(bytearray(self.random.getrandbits(8) for i in range(6)))
+            txpower = -59
+            rssi = txpower - 10 * exponent * math.log10(self.random.uniform(0.5, 20))
+            self.beacons.append((mac, uuid, major, minor, txpower, rssi))
+        self.sent = multiprocessing.Value('L', 0)
+        self.dropped = multiprocessing.Value('L', 0)
+        self.stop = multiprocessing.Event()
+        self.worker = None
+
+    def frame(self, i):
+        mac, uuid, major, minor, txpower, rssi = self.beacons[i % len(self.beacons)]
+        rssi = int(round(rssi + self.random.gauss(0, self.sigma)))
+        return advert_frame(mac, uuid, major, minor, txpower, max(-127, min(-30, rssi)))
+
+    def run(self):
+        "Generator loop, until stop is set"
+        self.sock.setblocking(False)
+        started = time.time()
+        sent = dropped = 0
+        while not self.stop.is_set():
+            if self.rate:
+                due = int((time.time() - started) * self.rate) - sent - dropped
+            else:
+                due = 1000
+            for i in range(due):
+                try:
+                    self.sock.send(self.frame(sent + dropped))
+                    sent += 1
+                except (IOError, OSError) as e:
+                    if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        raise
+                    dropped += due - i if self.rate else 0
+                    break
+            self.sent.value, self.dropped.value = sent, dropped
+            time.sleep(0.001)
+
+    def start(self, process=True):
+        "Runs generator in separate process, or thread to keep it in the same process"
+        if process:
+            self.worker = multiprocessing.Process(target=self.run)
+        else:
+            self.worker = threading.Thread(target=self.run)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def close(self):
+        self.stop.set()
+        if self.worker is not None:
+            self.worker.join()
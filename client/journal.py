@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+
+"""
+Event server simple client
+Waits for I-Beacons and sends messages
+Temporary stores messages in file
+
+
+MIT License
+
+Copyright (c) 2017 Roman Mindlin
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import os
+import errno
+import pickle
+
+import const
+import logger
+
+logger = logger.get_logger(__name__)
+
+
+class Journal(object):
+    """
+    Append-only log of pickled records next to a pickled snapshot file
+    append() writes a group of records with one write and fsync,
+    compact() atomically replaces snapshot (temp file + rename) and truncates the log
+    Records must be idempotent, they are replayed over the newer snapshot
+    if power is lost between rename and truncate
+    """
+
+    def __init__(self, path, max_size=const.JOURNAL_MAX_SIZE):
+        self.path = path
+        self.log_path = path + '.journal'
+        self.max_size = max_size
+        self.file = None
+
+    def load(self):
+        "Returns (snapshot or None, list of records), torn record at the end of log is dropped"
+        snapshot = None
+        try:
+            with open(self.path, 'rb') as f:
+                snapshot = pickle.load(f)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+        except Exception:
+            logger.error("Broken snapshot %s, moved aside", self.path, exc_info=True)
+            os.rename(self.path, self.path + '.broken')
+
+        records = []
+        try:
+            with open(self.log_path, 'rb') as f:
+                good = 0
+                while True:
+                    try:
+                        records.append(pickle.load(f))
+                        good = f.tell()
+                    except EOFError:
+                        break
+                    except Exception:
+                        logger.warning("Torn journal record at %s, dropped", good)
+                        break
+            if good < os.path.getsize(self.log_path):
+                with open(self.log_path, 'r+b') as f:
+                    f.truncate(good)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+        return snapshot, records
+
+    def append(self, records):
+        "Appends group of records, returns when they are on disk"
+        if not records:
+            return
+        if self.file is None:
+            self.file = open(self.log_path, 'ab')
+        self.file.write(b''.join(pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL) for record in records))
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def size(self):
+        if self.file is not None:
+            return self.file.tell()
+        try:
+            return os.path.getsize(self.log_path)
+        except OSError:
+            return 0
+
+    def full(self):
+        "True if log is big enough to compact"
+        return self.size() > self.max_size
+
+    def compact(self, snapshot):
+        "Writes snapshot atomically and truncates log"
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.path)
+        fsync_dir(os.path.dirname(os.path.abspath(self.path)))
+
+        if self.file is not None:
+            self.file.close()
+        self.file = open(self.log_path, 'wb')
+        os.fsync(self.file.fileno())
+
+
+def fsync_dir(path):
+    "Makes rename durable"
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
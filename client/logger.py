@@ -29,28 +29,130 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-import logging
-
-import const
-
-def get_logger(name):
-    "Setup logging"
-    LOG_LEVEL = logging.INFO
 
-    logger = logging.getLogger(name)
-    logger.setLevel(LOG_LEVEL)
+import os
+import atexit
+import logging
+import threading
+import logging.handlers
 
-    file_handler = logging.FileHandler(const.LOG_FILE)
-    file_handler.setLevel(LOG_LEVEL)
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
 
-    stream_handler = logging.StreamHandler()
-    stream_handler.setLevel(LOG_LEVEL)
+import const
 
-    formatter = logging.Formatter('%(asctime)s: %(name)s [%(levelname)s] %(message)s')
-    file_handler.setFormatter(formatter)
-    stream_handler.setFormatter(formatter)
+LOG_LEVEL = logging.INFO
+FORMAT = '%(asctime)s: %(name)s [%(levelname)s] %(message)s'
+
+QueueHandler = getattr(logging.handlers, 'QueueHandler', None)  # python 3.2+
+
+_lock = threading.Lock()
+_pipeline = {}
+
+
+if QueueHandler is not None:
+    class LogQueueHandler(QueueHandler):
+        """
+        Hands records over to writer thread as they are, message is formatted there too
+        Records are dropped and counted when writer thread falls behind
+        """
+        dropped = 0
+
+        def prepare(self, record):
+            return record
+
+        def enqueue(self, record):
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                self.dropped += 1
+
+
+def setup():
+    """
+    Sets up logging once: all loggers hand records to one writer thread,
+    which writes them to size-rotated LOG_FILE and stderr
+    Python 2 has no QueueHandler, records are written right away there
+    """
+    with _lock:
+        if _pipeline:
+            return
+        formatter = logging.Formatter(FORMAT)
+        file_handler = logging.handlers.RotatingFileHandler(const.LOG_FILE, maxBytes=const.LOG_MAX_SIZE,
+                                                            backupCount=const.LOG_BACKUPS)
+        stream_handler = logging.StreamHandler()
+        handlers = (file_handler, stream_handler)
+        for handler in handlers:
+            handler.setLevel(LOG_LEVEL)
+            handler.setFormatter(formatter)
+        _pipeline['handlers'] = handlers
+
+        root = logging.getLogger()
+        root.setLevel(LOG_LEVEL)
+        if QueueHandler is None:
+            for handler in handlers:
+                root.addHandler(handler)
+            return
+        _pipeline['handler'] = LogQueueHandler(queue.Queue(const.LOG_QUEUE_SIZE))
+        root.addHandler(_pipeline['handler'])
+        start_listener()
+        atexit.register(stop)
+        if hasattr(os, 'register_at_fork'):  # python 3.7+
+            os.register_at_fork(after_in_child=after_fork)
+
+
+def start_listener():
+    listener = logging.handlers.QueueListener(_pipeline['handler'].queue, *_pipeline['handlers'],
+                                              respect_handler_level=True)
+    listener.start()
+    _pipeline['listener'] = listener
+
+
+def after_fork():
+    "Forked process has no writer thread, starts its own with empty queue"
+    _pipeline['handler'].queue = queue.Queue(const.LOG_QUEUE_SIZE)
+    start_listener()
+
+
+def stop():
+    "Writes out queued records and stops writer thread, child processes call it before exit"
+    listener = _pipeline.pop('listener', None)
+    if listener is not None:
+        listener.stop()
+
+
+def dropped():
+    "Number of records dropped on full queue"
+    handler = _pipeline.get('handler')
+    return handler.dropped if handler is not None else 0
 
-    logger.addHandler(file_handler)
-    logger.addHandler(stream_handler)
 
-    return logger
\ No newline at end of file
+def get_logger(name):
+    "Returns named logger, sets logging up on first call"
+    setup()
+    return logging.getLogger(name)
+
+
+class RateLimit(object):
+    """
+    Lets through one message per key in interval seconds, for per-beacon messages
+    When there are more than max_keys keys, the ones not seen for interval are forgotten
+    """
+
+    def __init__(self, interval=const.LOG_BEACON_INTERVAL, max_keys=10000):
+        self.interval = interval
+        self.max_keys = max_keys
+        self.last = {}  # key: time of last message
+        self.suppressed = 0
+
+    def allow(self, key, now):
+        last = self.last.get(key)
+        if last is not None and now - last < self.interval:
+            self.suppressed += 1
+            return False
+        if len(self.last) >= self.max_keys:
+            self.last = dict((k, t) for k, t in self.last.items() if now - t < self.interval)
+        self.last[key] = now
+        return True
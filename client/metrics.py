@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+
+"""
+Event server simple client
+Waits for I-Beacons and sends messages
+Temporary stores messages in file
+
+
+MIT License
+
+Copyright (c) 2017 Roman Mindlin
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import os
+import json
+import time
+import bisect
+import threading
+
+from collections import OrderedDict
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:  # python 2
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+import const
+import logger
+from logger import dropped as log_dropped
+
+logger = logger.get_logger(__name__)
+
+# seconds, from 100 us to 10 s
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+class Counter(object):
+    "Growing number, changed by one thread"
+    __slots__ = ('value',)
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self):
+        return [('', self.value, ())]
+
+
+class Gauge(object):
+    "Current value, read from the owner by callback only when metrics are read"
+    __slots__ = ('read',)
+    kind = 'gauge'
+
+    def __init__(self, read):
+        self.read = read
+
+    def samples(self):
+        return [('', self.read(), ())]
+
+
+class Histogram(object):
+    "Distribution of observed values over fixed buckets, observed by one thread"
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+    kind = 'histogram'
+
+    def __init__(self, buckets=TIME_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            result.append(('_bucket', total, (('le', str(bound)),)))
+        result.append(('_sum', self.sum, ()))
+        result.append(('_count', self.count, ()))
+        return result
+
+
+class Registry(object):
+    """
+    Named metrics with optional labels
+    Updating metric is a plain attribute change, all the work is done when metrics are read
+    """
+
+    def __init__(self):
+        self.metrics = OrderedDict()  # (name, labels): metric
+        self.help = {}
+        self.lock = threading.Lock()
+
+    def register(self, name, labels, help, metric, replace=False):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if replace or key not in self.metrics:
+                self.metrics[key] = metric
+            if help:
+                self.help[name] = help
+            return self.metrics[key]
+
+    def counter(self, name, help='', **labels):
+        return self.register(name, labels, help, Counter())
+
+    def histogram(self, name, help='', buckets=TIME_BUCKETS, **labels):
+        return self.register(name, labels, help, Histogram(buckets))
+
+    def gauge(self, name, read, help='', **labels):
+        "Registers callback, the latest registered one is used"
+        return self.register(name, labels, help, Gauge(read), replace=True)
+
+    def collect(self):
+        "Returns [(name, kind, [(sample name, labels, value)])], broken gauges are skipped"
+        with self.lock:
+            items = list(self.metrics.items())
+        result = []
+        for (name, labels), metric in items:
+            try:
+                samples = metric.samples()
+            except:
+                continue
+            result.append((name, metric.kind,
+                           [(name + suffix, labels + extra, value) for suffix, value, extra in samples]))
+        return result
+
+    def render(self):
+        "Prometheus text format, samples of one name are grouped together"
+        families = OrderedDict()
+        for name, kind, samples in self.collect():
+            families.setdefault((name, kind), []).extend(samples)
+        lines = []
+        for (name, kind), samples in families.items():
+            if name in self.help:
+                lines.append('# HELP {} {}'.format(name, self.help[name]))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for sample, labels, value in samples:
+                if labels:
+                    sample += '{' + ','.join('{}="{}"'.format(k, v) for k, v in labels) + '}'
+                lines.append('{} {}'.format(sample, value))
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        "Plain dict of all samples, for stats file"
+        result = OrderedDict()
+        for name, kind, samples in self.collect():
+            for sample, labels, value in samples:
+                key = sample + ''.join(',{}={}'.format(k, v) for k, v in labels)
+                result[key] = value
+        return result
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+histogram = REGISTRY.histogram
+gauge = REGISTRY.gauge
+
+
+def rss():
+    "Resident set size of this process, bytes"
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+gauge('beacon_memory_rss_bytes', rss, 'Resident memory of client process')
+gauge('beacon_log_dropped_total', log_dropped, 'Log records dropped on full queue')
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=const.METRICS_PORT, host=const.METRICS_HOST):
+    "Starts /metrics HTTP endpoint in daemon thread, it sleeps until somebody asks"
+    server = HTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    logger.info("metrics on http://%s:%s/metrics", host, port)
+    return server
+
+
+def write_stats(path=const.METRICS_FILE):
+    "Writes all metrics to JSON file, atomically"
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(REGISTRY.snapshot(), f, indent=1)
+    os.rename(tmp, path)
@@ -29,67 +29,257 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
-import datetime
+import time
 
-from collections import deque
+from collections import deque, OrderedDict
+
+import const
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Kalman.filter_batch, 200 beacons: numpy 97/157/228/347/1550 us, python 75/150/309/611/5170 us
+# for 64/128/256/512/4096 samples; live batches stay far below, only scan backlogs reach numpy
+NUMPY_MIN_BATCH = 256
+
+
+def group(beacons):
+    """
+    Groups batch samples by beacon
+    Returns unique beacons, group number of every sample and index of last sample of every group
+    """
+    index = {}
+    keys = []
+    inverse = []
+    last = []
+    for i, beacon in enumerate(beacons):
+        g = index.get(beacon)
+        if g is None:
+            g = index[beacon] = len(keys)
+            keys.append(beacon)
+            last.append(i)
+        else:
+            last[g] = i
+        inverse.append(g)
+    return keys, inverse, last
+
+
+def filter_each(processor, beacons, rssi, now):
+    "Batch filtering fallback, calls processor.filter for every sample"
+    results = {}
+    for i, beacon in enumerate(beacons):
+        value = processor.filter(beacon, rssi[i], now)
+        if value is not None:
+            results[beacon] = (i, value)
+    return sorted(results.values())
+
+
+class StateStore(object):
+    """
+    Per-beacon filter state with hard entries limit
+    Entries are kept in last seen order, beacons not seen for ttl seconds
+    and the oldest ones over max_entries are evicted
+    """
+
+    def __init__(self, max_entries=const.FILTER_MAX_BEACONS, ttl=const.FILTER_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, beacon):
+        return beacon in self.entries
+
+    def get(self, beacon):
+        return self.entries.get(beacon)
+
+    def put(self, beacon, state, now):
+        "Stores beacon state as the most recently seen"
+        state.seen = now
+        self.entries.pop(beacon, None)
+        self.entries[beacon] = state
+
+    def pop(self, beacon):
+        return self.entries.pop(beacon, None)
+
+    def expire(self, now):
+        "Evicts beacons not seen for ttl seconds and the oldest ones over max_entries"
+        entries = self.entries
+        while entries:
+            beacon = next(iter(entries))
+            if len(entries) <= self.max_entries and now - entries[beacon].seen <= self.ttl:
+                break
+            del entries[beacon]
+            self.evicted += 1
+
+
+class KalmanState(object):
+    __slots__ = ('xhat', 'p', 'seen')
+
+    def __init__(self, xhat, p):
+        self.xhat = xhat
+        self.p = p
+
+
+class WindowState(object):
+    __slots__ = ('z', 'seen')
+
+    def __init__(self, window):
+        self.z = deque(maxlen=window)
+
+
+class AverageState(object):
+    __slots__ = ('rssi_sum', 'count', 'start', 'seen')
+
+    def __init__(self, rssi_sum, count, start):
+        self.rssi_sum = rssi_sum
+        self.count = count
+        self.start = start
 
 
 class Kalman(object):
     """
-    Implements Kalman filter for RSSI measuring
+    Implements scalar Kalman filter for RSSI measuring
+    Stores only a posteri estimate and its error per beacon, O(1) per sample
     """
 
-    def __init__(self):
-        self.beacons = {}
+    def __init__(self, q=const.KALMAN_Q, r=const.KALMAN_R, x0=const.KALMAN_X0, p0=const.KALMAN_P0):
+        self.q = q  # process variance
+        self.r = r  # estimate of measurement variance
+        self.x0 = x0  # initial estimate
+        self.p0 = p0  # initial error estimate
+        self.beacons = StateStore()
+
+    def filter(self, beacon, rssi, now=None):
+        "Takes beacon id and rssi, updates and returns rssi a posteri estimate"
+        if now is None:
+            now = time.time()
+        self.beacons.expire(now)
+        state = self.beacons.get(beacon) or KalmanState(self.x0, self.p0)
+        xhat, p = state.xhat, state.p
+
+        # time update
+        p += self.q
+
+        # measurement update
+        k = p / (p + self.r)
+        xhat += k * (rssi - xhat)
+        p = (1 - k) * p
 
-    def filter(self, beacon, rssi):
+        state.xhat, state.p = xhat, p
+        self.beacons.put(beacon, state, now)
+        return int(xhat)
+
+    def filter_batch(self, beacons, rssi, now=None):
         """
-        Takes beacon id and rssi, stores rssi in array and calculate rssi a posteri estimate
-        Didn't store its state due to memory restrictions (large number of beacons), 
-        but calculate all values every time (high cpu load)
+        Takes beacon ids and rssi values of one scan batch,
+        samples of every beacon are filtered in arrival order, all beacons at once
+        Returns list of (index of beacon's last sample, rssi a posteri estimate)
         """
-        try:
-            if self.beacons.get(beacon) is None:
-                self.beacons[beacon] = deque(maxlen=30)
-            self.beacons[beacon].append(rssi)
-            z = self.beacons[beacon]
-
-            # intial parameters
-            n_iter = len(z)
-            Q = 1e-6  # process variance
-            R = 0.1 ** 3  # estimate of measurement variance, change to see effect
-
-            # allocate space for arrays
-            xhat = list()  # a posteri estimate of x
-            P = list()  # a posteri error estimate
-            xhatminus = [0]  # a priori estimate of x
-            Pminus = [0]  # a priori error estimate
-            K = [0]  # gain or blending factor
-
-            # intial guesses
-            xhat.append(-40.0)
-            P.append(1.0)
-
-            for k in range(1, n_iter):
-                # time update
-                xhatminus.append(xhat[k - 1])
-                Pminus.append(P[k - 1] + Q)
-
-                # measurement update
-                K.append(Pminus[k] / (Pminus[k] + R))
-                xhat.append(xhatminus[k] + K[k] * (z[k] - xhatminus[k]))
-                P.append((1 - K[k]) * Pminus[k])
-
-            return int(xhat[-1])
-        except:
-            self.beacons[beacon] = [rssi]
-            return rssi
+        if now is None:
+            now = time.time()
+        if np is None or len(beacons) < NUMPY_MIN_BATCH:
+            return filter_each(self, beacons, rssi, now)
+
+        self.beacons.expire(now)
+        keys, inverse, last = group(beacons)
+        states = [self.beacons.get(beacon) or KalmanState(self.x0, self.p0) for beacon in keys]
+        xhat = np.array([state.xhat for state in states])
+        p = np.array([state.p for state in states])
+
+        # order samples by their number within beacon, keeping arrival order
+        inverse = np.asarray(inverse)
+        z = np.asarray(rssi, dtype=float)
+        counts = np.bincount(inverse)
+        by_beacon = np.argsort(inverse, kind='stable')
+        step = np.arange(len(inverse)) - np.repeat(np.cumsum(counts) - counts, counts)
+        order = by_beacon[np.argsort(step, kind='stable')]
+        step_ends = np.cumsum(np.bincount(step))
+
+        start = 0
+        for end in step_ends:
+            samples = order[start:end]
+            g = inverse[samples]
+            # time update
+            pminus = p[g] + self.q
+            # measurement update
+            k = pminus / (pminus + self.r)
+            xhat[g] += k * (z[samples] - xhat[g])
+            p[g] = (1 - k) * pminus
+            start = end
+
+        for g, beacon in enumerate(keys):
+            state = states[g]
+            state.xhat, state.p = float(xhat[g]), float(p[g])
+            self.beacons.put(beacon, state, now)
+        return sorted((last[g], int(xhat[g])) for g in range(len(keys)))
 
     def clear(self, beacon):
         """
         Delete lost beacon records
         """
-        self.beacons.pop(beacon, None)
+        self.beacons.pop(beacon)
+
+
+class WindowedKalman(Kalman):
+    """
+    Old Kalman implementation, kept to compare accuracy with the incremental one
+    Stores last window rssi values per beacon and recalculates the whole filter every sample
+    """
+
+    def __init__(self, window=const.KALMAN_WINDOW, **kwargs):
+        super(WindowedKalman, self).__init__(**kwargs)
+        self.window = window
+
+    def filter(self, beacon, rssi, now=None):
+        """
+        Takes beacon id and rssi, stores rssi in array and calculate rssi a posteri estimate
+        Didn't store its state due to memory restrictions (large number of beacons), 
+        but calculate all values every time (high cpu load)
+        """
+        if now is None:
+            now = time.time()
+        self.beacons.expire(now)
+        state = self.beacons.get(beacon) or WindowState(self.window)
+        state.z.append(rssi)
+        self.beacons.put(beacon, state, now)
+        z = state.z
+
+        # intial parameters
+        n_iter = len(z)
+        Q = self.q  # process variance
+        R = self.r  # estimate of measurement variance, change to see effect
+
+        # allocate space for arrays
+        xhat = list()  # a posteri estimate of x
+        P = list()  # a posteri error estimate
+        xhatminus = [0]  # a priori estimate of x
+        Pminus = [0]  # a priori error estimate
+        K = [0]  # gain or blending factor
+
+        # intial guesses
+        xhat.append(self.x0)
+        P.append(self.p0)
+
+        for k in range(1, n_iter):
+            # time update
+            xhatminus.append(xhat[k - 1])
+            Pminus.append(P[k - 1] + Q)
+
+            # measurement update
+            K.append(Pminus[k] / (Pminus[k] + R))
+            xhat.append(xhatminus[k] + K[k] * (z[k] - xhatminus[k]))
+            P.append((1 - K[k]) * Pminus[k])
+
+        return int(xhat[-1])
+
+    def filter_batch(self, beacons, rssi, now=None):
+        return filter_each(self, beacons, rssi, time.time() if now is None else now)
 
 
 class OneSecondAverage(object):
@@ -97,32 +287,55 @@ class OneSecondAverage(object):
     Calculates average for one second
     """
 
-    def __init__(self):
-        self.beacons = {}
-
-    def filter(self, beacon, rssi):
-        try:
-            if self.beacons.get(beacon) is None:
-                d = deque(maxlen=30)
-                d.append(rssi)
-                self.beacons[beacon] = d, datetime.datetime.now()
-            else:
-                d, t = self.beacons[beacon]
-                if datetime.datetime.now() - t > datetime.timedelta(seconds=1):
-                    rssi_average = sum(d) // len(d)
-                    d.clear()
-                    d.append(rssi)
-                    self.beacons[beacon] = d, datetime.datetime.now()
-                    return rssi_average
-                else:
-                    d.append(rssi)
-                    return None
-
-        except:
-            return None
+    def __init__(self, period=1.0):
+        self.period = period
+        self.beacons = StateStore()
+
+    def filter(self, beacon, rssi, now=None):
+        if now is None:
+            now = time.time()
+        self.beacons.expire(now)
+        return self.update(beacon, rssi, 1, now)
+
+    def update(self, beacon, rssi_sum, count, now):
+        "Adds samples to current beacon period, returns average of previous period when it is over"
+        state = self.beacons.get(beacon)
+        rssi_average = None
+        if state is None:
+            state = AverageState(rssi_sum, count, now)
+        elif now - state.start > self.period:
+            rssi_average = int(state.rssi_sum // state.count)
+            state.rssi_sum, state.count, state.start = rssi_sum, count, now
+        else:
+            state.rssi_sum += rssi_sum
+            state.count += count
+        self.beacons.put(beacon, state, now)
+        return rssi_average
+
+    def filter_batch(self, beacons, rssi, now=None):
+        """
+        Takes beacon ids and rssi values of one scan batch, the batch is treated as taken at one time
+        Returns list of (index of beacon's last sample, rssi average)
+        """
+        if now is None:
+            now = time.time()
+        self.beacons.expire(now)
+        keys, inverse, last = group(beacons)
+        counts = [0] * len(keys)
+        sums = [0] * len(keys)
+        for i, g in enumerate(inverse):
+            counts[g] += 1
+            sums[g] += rssi[i]
+
+        results = []
+        for g, beacon in enumerate(keys):
+            value = self.update(beacon, sums[g], counts[g], now)
+            if value is not None:
+                results.append((last[g], value))
+        return results
 
     def clear(self, beacon):
         """
         Delete lost beacon records
         """
-        self.beacons.pop(beacon, None)
+        self.beacons.pop(beacon)
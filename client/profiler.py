@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+"""
+Event server simple client
+Waits for I-Beacons and sends messages
+Temporary stores messages in file
+
+
+MIT License
+
+Copyright (c) 2017 Roman Mindlin
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import os
+import sys
+import time
+import signal
+import threading
+
+from collections import Counter
+
+import const
+import logger
+
+logger = logger.get_logger(__name__)
+
+
+class Profiler(object):
+    """
+    Sampling profiler for the running client, costs nothing until triggered
+    Triggered by SIGUSR1 or by control file PROFILE_TRIGGER (it may hold number of seconds),
+    samples stacks of all threads every interval for duration seconds and writes them
+    in collapsed format (thread;outer frame;...;inner frame count) next to LOG_FILE,
+    ready for flamegraph.pl or speedscope
+    """
+
+    def __init__(self, interval=const.PROFILE_INTERVAL, duration=const.PROFILE_DURATION,
+                 trigger=const.PROFILE_TRIGGER):
+        self.interval = interval
+        self.duration = duration
+        self.trigger = trigger
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def install(self):
+        "Sets SIGUSR1 handler, must be called from main thread"
+        if hasattr(signal, 'SIGUSR1'):
+            signal.signal(signal.SIGUSR1, lambda signum, frame: self.start())
+
+    def check_trigger(self):
+        "Starts profiling if control file exists, called periodically by saver thread"
+        if not self.trigger or not os.path.exists(self.trigger):
+            return
+        duration = self.duration
+        try:
+            with open(self.trigger) as f:
+                duration = float(f.read().strip() or duration)
+        except (IOError, ValueError):
+            pass
+        try:
+            os.remove(self.trigger)
+        except OSError:
+            pass
+        self.start(duration)
+
+    def start(self, duration=None):
+        "Starts sampler thread unless it is running already"
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self.run, args=(duration or self.duration,), name='profiler')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def run(self, duration):
+        logger.info("profiling for %s seconds", duration)
+        stacks = Counter()
+        me = threading.current_thread().ident
+        started = time.time()
+        samples = 0
+        while time.time() - started < duration:
+            names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s (%s)' % (code.co_name, os.path.basename(code.co_filename)))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stacks[';'.join(reversed(stack))] += 1
+            samples += 1
+            time.sleep(self.interval)
+        path = os.path.join(os.path.dirname(const.LOG_FILE),
+                            time.strftime('profile-%Y%m%d-%H%M%S.folded', time.localtime(started)))
+        try:
+            with open(path, 'w') as f:
+                for stack, count in stacks.most_common():
+                    f.write('%s %d\n' % (stack, count))
+            logger.info("profile of %s samples written to %s", samples, path)
+        except:
+            logger.error("Cannot write profile", exc_info=True)
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+"""
+Event server simple client
+Waits for I-Beacons and sends messages
+Temporary stores messages in file
+
+
+MIT License
+
+Copyright (c) 2017 Roman Mindlin
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import os
+import io
+import time
+import gzip
+import zlib
+import struct
+
+import const
+import logger
+
+logger = logger.get_logger(__name__)
+
+MAGIC = b'BCAP'
+VERSION = 1
+HEADER = struct.Struct('<4sBdd')  # magic, version, wall clock and monotonic time of file start
+FRAME_SIZE = 62  # one LE advertising report frame always fits
+RECORD = struct.Struct('<dBB%ds' % FRAME_SIZE)  # monotonic time, adapter, frame length, frame padded with zeros
+
+
+class Recorder(object):
+    """
+    Writes raw HCI frames to capture file of fixed-width records
+    Records are buffered in memory and written in chunks, optionally gzip-compressed
+    When file grows over max_size it is rotated like logging.RotatingFileHandler does:
+    path -> path.1 -> ... -> path.keep
+    Frames longer than FRAME_SIZE are not recorded, only counted
+    """
+
+    def __init__(self, path=const.CAPTURE_FILE, max_size=const.CAPTURE_MAX_SIZE, keep=const.CAPTURE_KEEP,
+                 compress=const.CAPTURE_COMPRESS, buffer_size=64 * 1024):
+        self.path = path + '.gz' if compress else path
+        self.max_size = max_size
+        self.keep = keep
+        self.compress = compress
+        self.buffer_size = buffer_size
+        self.buffer = bytearray()
+        self.file = None
+        self.size = 0  # uncompressed bytes in current file
+        self.counters = {'records': 0, 'oversize': 0, 'files': 0}
+
+    def open(self, now):
+        f = open(self.path, 'wb')
+        self.file = gzip.GzipFile(fileobj=f, mode='wb') if self.compress else f
+        self.buffer += HEADER.pack(MAGIC, VERSION, time.time(), now)
+        self.size = HEADER.size
+        self.counters['files'] += 1
+
+    def write(self, now, dev_id, frame, length):
+        "Adds frame captured by adapter dev_id at monotonic time now"
+        if length > FRAME_SIZE:
+            self.counters['oversize'] += 1
+            return
+        if self.file is None:
+            self.open(now)
+        self.buffer += RECORD.pack(now, dev_id, length, bytes(frame[:length]))
+        self.size += RECORD.size
+        self.counters['records'] += 1
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+            if self.size >= self.max_size:
+                self.rotate()
+
+    def flush(self):
+        "Writes buffered records, compressed ones are sync-flushed so that they can be read without gzip trailer"
+        if self.file is not None:
+            self.file.write(self.buffer)
+            self.file.flush()
+            self.buffer = bytearray()
+
+    def rotate(self):
+        "Closes current file and shifts older ones, the next write starts a new file"
+        self.close()
+        for i in range(self.keep - 1, 0, -1):
+            src = '{}.{}'.format(self.path, i)
+            if os.path.exists(src):
+                os.rename(src, '{}.{}'.format(self.path, i + 1))
+        if self.keep > 0:
+            os.rename(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+
+    def close(self):
+        if self.file is not None:
+            self.flush()
+            if self.compress:
+                f = self.file.fileobj
+                self.file.close()
+                f.close()
+            else:
+                self.file.close()
+            self.file = None
+
+
+def open_capture(path):
+    "Opens capture file, plain or compressed, returns (file, wall clock time, monotonic time) of its start"
+    with open(path, 'rb') as f:
+        compressed = f.read(2) == b'\x1f\x8b'
+    f = gzip.GzipFile(path, 'rb') if compressed else io.open(path, 'rb')
+    header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        f.close()
+        raise ValueError('{} is empty'.format(path))
+    magic, version, wall, start = HEADER.unpack(header)
+    if magic != MAGIC or version != VERSION:
+        f.close()
+        raise ValueError('{} is not a capture file'.format(path))
+    return f, wall, start
+
+
+def read_records(f, chunk_size=64 * 1024):
+    """
+    Yields (monotonic time, adapter, frame) records of opened capture file, closes it on the end
+    File of a client killed while writing has no gzip trailer, its intact records are read anyway
+    """
+    read = getattr(f, 'read1', f.read)  # read1 returns what is decompressed before the damaged tail
+    pending = b''
+    with f:
+        while True:
+            try:
+                chunk = read(chunk_size)
+            except (EOFError, zlib.error) as e:
+                logger.warning("%s is truncated, replayed up to the damage: %s", getattr(f, 'name', 'capture'), e)
+                chunk = b''
+            if not chunk:
+                if pending:
+                    logger.warning("%s ends with a partial record", getattr(f, 'name', 'capture'))
+                return
+            data = pending + chunk
+            end = len(data) - len(data) % RECORD.size
+            for offset in range(0, end, RECORD.size):
+                now, dev_id, length, frame = RECORD.unpack_from(data, offset)
+                yield now, dev_id, frame[:length]
+            pending = data[end:]
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+
+"""
+Event server simple client
+Waits for I-Beacons and sends messages
+Temporary stores messages in file
+
+
+MIT License
+
+Copyright (c) 2017 Roman Mindlin
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+# Replays capture files recorded with const.DUMP through blescan, processors and Beacons
+# python replay.py [--realtime] [--processor average|kalman|windowed] capture.bin.gz.1 capture.bin.gz
+# Rotated files of one client run are given oldest first, visits are stored to temporary directory
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import const
+
+import blescan
+import capture
+import processors
+from beacon import Beacons
+from spool import Spool
+from distance import DistanceModel
+from recorder import open_capture, read_records
+from beacon_client import process
+
+PROCESSORS = {
+    'average': processors.OneSecondAverage,
+    'kalman': processors.Kalman,
+    'windowed': processors.WindowedKalman,
+}
+
+
+def replay(paths, processor, workdir, realtime=False, interval=const.SEND_INTERVAL):
+    """
+    Feeds captured frames to the pipeline in batches of interval seconds of capture time,
+    at real time speed or as fast as possible, visits are stored in workdir. Returns counters
+    """
+    const.SAVE_FILE = os.path.join(workdir, 'beacons.pkl')
+    advert_filter = blescan.AdvertFilter(const.IBEACON_PREFIX, const.ALLOWED_UUID,
+                                         const.ALLOWED_MAJOR, const.ALLOWED_MINOR)
+    merger = capture.Merger(const.HCI_DEVICES)
+    spool = Spool(os.path.join(workdir, 'spool.pkl'))
+    beacons = Beacons(spool)
+    distance_model = DistanceModel()
+    counters = {'frames': 0, 'adverts': 0, 'batches': 0}
+    state = {'offset': 0, 'batches': 0}
+
+    def step(now):
+        reports = merger.pop(now)
+        wall = now + state['offset']
+        beacons.tick(wall)
+        if reports:
+            process(reports, wall, processor, distance_model, beacons)
+            counters['adverts'] += len(reports)
+        counters['batches'] += 1
+        if counters['batches'] % int(const.SAVE_TIMEOUT / interval) == 0:
+            beacons.save(timeout=0)  # flushed by the next tick, like saver thread does
+
+    started = time.time()
+    first = batch_end = None
+    for path in paths:
+        f, wall, start = open_capture(path)
+        if first is None:
+            state['offset'] = wall - start  # monotonic to wall clock time, files are of one client run
+        for now, dev_id, frame in read_records(f):
+            if batch_end is None:
+                first, batch_end = now, now + interval
+            while now >= batch_end:
+                step(batch_end)
+                batch_end += interval
+            if realtime:
+                delay = (now - first) - (time.time() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            merger.add(dev_id, now, blescan.parse_packet(frame, len(frame), None, advert_filter))
+            counters['frames'] += 1
+
+    if batch_end is not None:
+        step(batch_end + merger.window)
+        beacons.tick(batch_end + state['offset'] + const.TIMEOUT + 1)  # finish all visits
+        beacons.save(timeout=0)
+        beacons.tick()
+        beacons.save(timeout=0)
+    counters['elapsed'] = time.time() - started
+    counters['capture'] = batch_end - first if first is not None else 0
+    counters['visits'] = spool.counters['put']
+    counters['filter'] = advert_filter.counters
+    return counters
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay capture files through the client pipeline')
+    parser.add_argument('paths', nargs='+', help='capture files, oldest first')
+    parser.add_argument('--realtime', action='store_true', help='keep original timing')
+    parser.add_argument('--processor', choices=sorted(PROCESSORS), default='average')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    counters = replay(args.paths, PROCESSORS[args.processor](), workdir, args.realtime)
+    print("{frames} frames, {adverts} adverts, {visits} visits in {capture:.1f} s of capture".format(**counters))
+    print("replayed in {:.2f} s, {:.0f} frames/s".format(
+        counters['elapsed'], counters['frames'] / counters['elapsed'] if counters['elapsed'] else 0))
+    print("filter counters: {}".format(counters['filter']))
+    print("visits stored in {}".format(workdir))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+"""
+Event server simple client
+Waits for I-Beacons and sends messages
+Temporary stores messages in file
+
+
+MIT License
+
+Copyright (c) 2017 Roman Mindlin
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import struct
+import multiprocessing
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # python < 3.8
+    shared_memory = None
+
+import const
+from blescan import HCI_MAX_EVENT_SIZE
+
+COUNTER = struct.Struct('<Q')
+HEAD = 0  # frames written, changed by producer only
+DROPPED = 8  # frames dropped on full buffer, changed by producer only
+TAIL = 64  # frames read, changed by consumer only, own cache line
+SLOTS = 128
+SLOT_HDR = struct.Struct('<dH')  # capture time, frame length
+SLOT_SIZE = (SLOT_HDR.size + HCI_MAX_EVENT_SIZE + 7) // 8 * 8
+
+
+class RingBuffer(object):
+    """
+    Single producer single consumer ring buffer of HCI frames in shared memory
+    Slot is capture time, frame length and frame padded to HCI_MAX_EVENT_SIZE
+    Counters only grow, slot of frame n is n % slots
+    Producer writes slot before publishing new head, consumer reads slots before publishing new tail.
+    Head and tail are read and published under lock: plain stores to shared memory may be reordered
+    on ARM, semaphore operations are memory barriers, so slot contents are visible before the counter
+    which publishes them. Slots are copied outside of the lock
+    Created by parent process and inherited by forked children, or attached by name and lock of creator
+    """
+
+    def __init__(self, slots=const.RING_SLOTS, name=None, lock=None):
+        if shared_memory is None:
+            raise RuntimeError('shared memory requires python 3.8+')
+        self.slots = slots
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=SLOTS + slots * SLOT_SIZE)
+            self.shm.buf[:SLOTS] = bytes(SLOTS)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.buf = self.shm.buf
+        self.lock = lock if lock is not None else multiprocessing.Lock()
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def dropped(self):
+        return COUNTER.unpack_from(self.buf, DROPPED)[0]
+
+    def counters(self):
+        "Returns (head, tail)"
+        with self.lock:
+            return COUNTER.unpack_from(self.buf, HEAD)[0], COUNTER.unpack_from(self.buf, TAIL)[0]
+
+    def __len__(self):
+        head, tail = self.counters()
+        return head - tail
+
+    def put(self, frame, length, now):
+        "Producer: copies frame, returns False if buffer is full"
+        head, tail = self.counters()
+        if head - tail >= self.slots:
+            COUNTER.pack_into(self.buf, DROPPED, self.dropped + 1)
+            return False
+        offset = SLOTS + (head % self.slots) * SLOT_SIZE
+        SLOT_HDR.pack_into(self.buf, offset, now, length)
+        offset += SLOT_HDR.size
+        self.buf[offset:offset + length] = frame[:length]
+        with self.lock:
+            COUNTER.pack_into(self.buf, HEAD, head + 1)
+        return True
+
+    def frames(self, max_count):
+        """
+        Consumer: yields (capture_time, frame view, length) of up to max_count pending frames
+        Views are released on the next item, slots are freed when iteration stops
+        """
+        head, tail = self.counters()
+        count = min(head - tail, max_count)
+        done = 0
+        try:
+            while done < count:
+                offset = SLOTS + ((tail + done) % self.slots) * SLOT_SIZE
+                now, length = SLOT_HDR.unpack_from(self.buf, offset)
+                offset += SLOT_HDR.size
+                frame = self.buf[offset:offset + HCI_MAX_EVENT_SIZE]
+                yield now, frame, length
+                frame.release()
+                done += 1
+        finally:
+            with self.lock:
+                COUNTER.pack_into(self.buf, TAIL, tail + done)
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+
+    def unlink(self):
+        "Frees shared memory, called once by creator"
+        self.shm.unlink()
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+
+"""
+Event server simple client
+Waits for I-Beacons and sends messages
+Temporary stores messages in file
+
+
+MIT License
+
+Copyright (c) 2017 Roman Mindlin
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+
+import random
+import threading
+
+from collections import OrderedDict
+
+import const
+import logger
+from journal import Journal
+
+logger = logger.get_logger(__name__)
+
+
+class Spool(object):
+    """
+    Durable outbound queue, survives restarts
+    Kept in memory as OrderedDict[seq] = (put_time, payload) and in journal of
+    ('put', seq, put_time, payload) and ('del', seq) records, written by flush()
+    When full, the oldest items are dropped
+    Short lock guards memory state only, file writes are done outside of it
+    """
+
+    def __init__(self, path=const.SPOOL_FILE, max_items=const.SPOOL_MAX_ITEMS):
+        self.max_items = max_items
+        self.items = OrderedDict()
+        self.records = []
+        self.next_seq = 0
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.compact_request = False
+        self.counters = dict.fromkeys(('put', 'delivered', 'rejected', 'dropped'), 0)
+
+        self.journal = Journal(path)
+        try:
+            self.load()
+        except:
+            logger.error('Cannot load spool', exc_info=True)
+
+    def __len__(self):
+        return len(self.items)
+
+    def load(self):
+        snapshot, records = self.journal.load()
+        if snapshot is not None:
+            self.next_seq = snapshot['next_seq']
+            for seq, put_time, payload in snapshot['items']:
+                self.items[seq] = (put_time, payload)
+        for record in records:
+            if record[0] == 'put':
+                self.items[record[1]] = record[2:]
+                self.next_seq = max(self.next_seq, record[1] + 1)
+            elif record[0] == 'del':
+                self.items.pop(record[1], None)
+        self.items = OrderedDict(sorted(self.items.items()))
+        self.trim()
+        logger.info("%s messages in spool", len(self.items))
+        if records:
+            self.journal.compact(self.snapshot())
+
+    def snapshot(self):
+        return {'next_seq': self.next_seq,
+                'items': [(seq, put_time, payload) for seq, (put_time, payload) in self.items.items()]}
+
+    def trim(self):
+        "Drops the oldest items over max_items"
+        while len(self.items) > self.max_items:
+            seq, item = self.items.popitem(last=False)
+            self.records.append(('del', seq))
+            self.counters['dropped'] += 1
+
+    def put(self, payload, now):
+        "Adds message to spool"
+        with self.lock:
+            seq = self.next_seq
+            self.next_seq += 1
+            self.items[seq] = (now, payload)
+            self.records.append(('put', seq, now, payload))
+            self.counters['put'] += 1
+            self.trim()
+
+    def peek(self, count):
+        "Returns up to count oldest items as (seq, put_time, payload)"
+        with self.lock:
+            result = []
+            for seq in self.items:
+                if len(result) == count:
+                    break
+                put_time, payload = self.items[seq]
+                result.append((seq, put_time, payload))
+            return result
+
+    def remove(self, seqs, counter='delivered'):
+        "Removes delivered or rejected items"
+        with self.lock:
+            for seq in seqs:
+                if self.items.pop(seq, None) is not None:
+                    self.records.append(('del', seq))
+                    self.counters[counter] += 1
+
+    def flush(self):
+        "Writes changes to journal, compacts it when it is too big"
+        with self.flush_lock:
+            with self.lock:
+                records, self.records = self.records, []
+                snapshot = self.snapshot() if self.compact_request else None
+                self.compact_request = False
+            if snapshot is not None:
+                self.journal.compact(snapshot)
+            else:
+                self.journal.append(records)
+                self.compact_request = self.journal.full()
+
+
+class CircuitBreaker(object):
+    """
+    Guards requests to server
+    closed - requests go through, threshold consecutive failures open the breaker
+    open - no requests until retry time, exponential backoff with full jitter
+    half-open - single probe request, success closes breaker, failure opens it again
+    """
+
+    def __init__(self, threshold=const.BREAKER_THRESHOLD, base=const.BACKOFF_BASE, cap=const.BACKOFF_MAX):
+        self.threshold = threshold
+        self.base = base
+        self.cap = cap
+        self.failures = 0
+        self.opened = 0  # times opened in a row
+        self.retry_at = 0
+        self.state = 'closed'
+
+    def allow(self, now):
+        "True if request may be sent now"
+        if self.state == 'open' and now >= self.retry_at:
+            self.state = 'half-open'
+        return self.state != 'open'
+
+    def success(self):
+        if self.state != 'closed':
+            logger.info("Server is back, circuit closed")
+        self.state = 'closed'
+        self.failures = 0
+        self.opened = 0
+
+    def failure(self, now):
+        self.failures += 1
+        if self.state == 'half-open' or self.failures >= self.threshold:
+            delay = random.uniform(0, min(self.cap, self.base * 2 ** self.opened))
+            if self.state == 'closed':
+                logger.warning("Server not responding, circuit open")
+            self.opened += 1
+            self.state = 'open'
+            self.retry_at = now + delay
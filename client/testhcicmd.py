@@ -0,0 +1,72 @@
+# checks HCI command packets sent to the controller: LE scan parameters, enable and disable, scan start sequence
+# python testhcicmd.py
+
+import sys
+
+import blescan
+import capture
+import const
+from fakebluez import FakeSocket
+
+SET_PARAMETERS = (blescan.OGF_LE_CTL, blescan.OCF_LE_SET_SCAN_PARAMETERS)
+SET_ENABLE = (blescan.OGF_LE_CTL, blescan.OCF_LE_SET_SCAN_ENABLE)
+
+failed = []
+
+
+def check(name, got, expected):
+    if got != expected:
+        failed.append(name)
+        print("{}: got {!r}, expected {!r}".format(name, got, expected))
+
+
+sock = FakeSocket()
+blescan.hci_le_set_scan_parameters(sock, blescan.LE_SCAN_ACTIVE, 0x0010, 0x0010, blescan.LE_RANDOM_ADDRESS)
+blescan.hci_le_set_scan_parameters(sock)
+blescan.hci_le_set_scan_parameters(sock, blescan.LE_SCAN_PASSIVE, 0x0640, 0x0320)
+blescan.hci_enable_le_scan(sock, filter_dup=True)
+blescan.hci_enable_le_scan(sock)
+blescan.hci_disable_le_scan(sock)
+check('set parameters active', sock.commands[0], SET_PARAMETERS + (b'\x01\x10\x00\x10\x00\x01\x00',))
+check('set parameters default', sock.commands[1], SET_PARAMETERS + (b'\x00\x10\x00\x10\x00\x00\x00',))
+check('set parameters 1s/0.5s', sock.commands[2], SET_PARAMETERS + (b'\x00\x40\x06\x20\x03\x00\x00',))
+check('enable with filter_dup', sock.commands[3], SET_ENABLE + (b'\x01\x01',))
+check('enable', sock.commands[4], SET_ENABLE + (b'\x01\x00',))
+check('disable', sock.commands[5], SET_ENABLE + (b'\x00\x00',))
+sock.close()
+
+sock = FakeSocket()
+for interval, window in ((0x0003, 0x0003), (0x0010, 0x0020), (0x4001, 0x0010)):
+    try:
+        blescan.hci_le_set_scan_parameters(sock, interval=interval, window=window)
+        check('bad interval 0x%04x/0x%04x' % (interval, window), 'sent', 'ValueError')
+    except ValueError:
+        pass
+check('nothing sent on bad parameters', sock.commands, [])
+sock.close()
+
+# scan start: disable, parameters from const, enable
+sock = FakeSocket()
+blescan.hci_open_dev = lambda dev_id: sock
+const.SCAN_ACTIVE, const.SCAN_INTERVAL, const.SCAN_WINDOW, const.SCAN_RANDOM_ADDRESS = True, 0x0030, 0x0020, False
+const.FILTER_DUPLICATES = True
+capture.open_device(0)
+check('open device', sock.commands, [SET_ENABLE + (b'\x00\x00',),
+                                     SET_PARAMETERS + (b'\x01\x30\x00\x20\x00\x00\x00',),
+                                     SET_ENABLE + (b'\x01\x01',)])
+
+# duplicate filter rearm: disable, enable with filter_dup
+del sock.commands[:]
+scanner = blescan.Scanner(sock, None, filter_dup=True, rearm_interval=1)
+# event packets only, all events, on little endian host
+check('event filter', sock.hci_filter, b'\x10\x00\x00\x00' + b'\xff' * 8 + b'\x00\x00')
+scanner.rearm()
+check('rearm', sock.commands, [SET_ENABLE + (b'\x00\x00',), SET_ENABLE + (b'\x01\x01',)])
+scanner.close()
+check('filter restored', sock.hci_filter, bytes(bytearray(14)))
+sock.close()
+
+if failed:
+    print("FAILED: {}".format(', '.join(failed)))
+    sys.exit(1)
+print("OK")
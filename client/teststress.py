@@ -0,0 +1,93 @@
+# stress test for Beacons and Spool threading: scanner, sender and saver threads run flat out
+# python teststress.py [seconds]
+
+import os
+import sys
+import time
+import random
+import tempfile
+import threading
+
+import const
+
+workdir = tempfile.mkdtemp()
+const.SAVE_FILE = os.path.join(workdir, 'beacons.pkl')
+const.SPOOL_FILE = os.path.join(workdir, 'spool.pkl')
+const.LOG_FILE = os.path.join(workdir, 'beacon_client.log')
+const.TIMEOUT = 0.05
+const.JOURNAL_MAX_SIZE = 64 * 1024
+
+from beacon import Beacons
+from spool import Spool
+
+duration = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+spool = Spool()
+beacons = Beacons(spool)
+stop = threading.Event()
+errors = []
+stats = {'adds': 0, 'acks': 0, 'saves': 0}
+
+
+def scanner():
+    identities = [(os.urandom(6), os.urandom(16), 1, minor) for minor in range(2000)]
+    try:
+        while not stop.is_set():
+            now = time.time()
+            for identity in random.sample(identities, 200):
+                beacons.add(identity, now, random.randint(0, 15))
+                stats['adds'] += 1
+            beacons.tick(now)
+    except Exception as e:
+        errors.append(('scanner', e))
+        raise
+
+
+def sender():
+    try:
+        while not stop.is_set():
+            items = spool.peek(100)
+            delivered = [item[0] for item in items if random.random() < 0.5]
+            spool.remove(delivered)
+            stats['acks'] += len(delivered)
+    except Exception as e:
+        errors.append(('sender', e))
+        raise
+
+
+def saver():
+    try:
+        while not stop.is_set():
+            beacons.save(timeout=1)
+            stats['saves'] += 1
+    except Exception as e:
+        errors.append(('saver', e))
+        raise
+
+
+threads = [threading.Thread(target=f) for f in (scanner, sender, saver)]
+for t in threads:
+    t.start()
+time.sleep(duration)
+stop.set()
+for t in threads:
+    t.join()
+
+# drain: let scanner thread apply what is left and save it
+beacons.tick()
+beacons.save(timeout=0)
+beacons.tick()
+beacons.save(timeout=0)
+
+print("adds: {adds}, acks: {acks}, saves: {saves}".format(**stats))
+print("visits: {} active, spool: {} messages, {}".format(len(beacons.active), len(spool), spool.counters))
+
+expected = sorted(beacons.snapshot()['visits'])
+expected_spool = spool.snapshot()['items']
+restored_spool = Spool()
+restored = sorted(Beacons(restored_spool).snapshot()['visits'])
+both = set(visit[0] for visit in expected) & set(item[2].uid for item in expected_spool)
+if errors or expected != restored or expected_spool != restored_spool.snapshot()['items'] or both:
+    print("FAILED: errors {}, restored {} of {} visits, {} of {} messages, {} in both".format(
+        errors, len(restored), len(expected), len(restored_spool), len(expected_spool), len(both)))
+    sys.exit(1)
+print("OK")
@@ -31,11 +31,17 @@ SOFTWARE.
 
 from flask import Flask, request, jsonify, render_template
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import aliased
 from flask_migrate import Migrate
 import os
 from dateutil import parser
 import sys
+import json
+import zlib
+import hashlib
+import datetime
+import threading
+from collections import OrderedDict, namedtuple
+from itertools import groupby
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
@@ -52,11 +58,33 @@ app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
 
+RECENT_KEYS_SIZE = 10000  # natural keys of recently stored records remembered in process
+OPEN_VISITS_HORIZON = datetime.timedelta(hours=1)  # visits ended this long before the newest one are not indexed
+OPEN_VISITS_PRUNE = 1000  # visits added between index prunes
+
 """
  ****************** MODELS ******************
 """
 
 
+def natural_key(*values):
+    "sha1 of record identifying values, retries of the same record give the same key"
+    parts = []
+    for value in values:
+        if value is None:
+            parts.append(u'')
+        elif isinstance(value, datetime.datetime):
+            parts.append(value.isoformat())
+        else:
+            parts.append(u'{}'.format(value))
+    return hashlib.sha1(u'\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+
+def as_int(value):
+    "Posted numbers may come as strings"
+    return None if value is None else int(value)
+
+
 class Beacon(db.Model):
     "I-beacon data model"
     __tablename__ = 'beacons'
@@ -70,6 +98,20 @@ class Beacon(db.Model):
     out_time = db.Column(db.DateTime, index=True)
     min_dist = db.Column(db.Integer)
     min_time = db.Column(db.DateTime)
+    natural_key = db.Column(db.String(40), unique=True, index=True)
+    gate_id = db.Column(db.Integer)  # gate of agent when message came in
+    side = db.Column(db.Enum('left', 'right'))
+
+    __table_args__ = (db.Index('ix_beacons_gate_visit', 'gate_id', 'ibeacon_uuid', 'ibeacon_major', 'ibeacon_minor',
+                               'in_time'),
+                      db.Index('ix_beacons_gate_id', 'gate_id', 'id'),  # new visits of gate
+                      db.Index('ix_beacons_gate_out_time', 'gate_id', 'out_time'))  # visits lasting until time
+
+    def make_key(self):
+        "Natural key of message: all posted fields"
+        return natural_key(self.__tablename__, self.raspi_serial, self.ibeacon_uuid,
+                           as_int(self.ibeacon_major), as_int(self.ibeacon_minor),
+                           self.in_time, self.out_time, as_int(self.min_dist), self.min_time)
 
     @property
     def serialize(self):
@@ -95,6 +137,12 @@ class Gate(db.Model):
     raspi_serial_left = db.Column(db.String(14), index=True)
     raspi_serial_right = db.Column(db.String(14), index=True)
     distance = db.Column(db.Integer)
+    natural_key = db.Column(db.String(40), unique=True, index=True)
+
+    def make_key(self):
+        "Natural key of gate: both agents and distance"
+        return natural_key(self.__tablename__, self.raspi_serial_left, self.raspi_serial_right,
+                           as_int(self.distance))
 
     @property
     def serialize(self):
@@ -121,6 +169,13 @@ class Event(db.Model):
     min_time_left = db.Column(db.DateTime)
     min_time_right = db.Column(db.DateTime)
     course = db.Column(db.Enum('left', 'center', 'right', 'wide'))
+    natural_key = db.Column(db.String(40), unique=True, index=True)
+
+    def make_key(self):
+        "Natural key of event: gate, beacon, times and course"
+        return natural_key(self.__tablename__, as_int(self.gate_id), self.ibeacon_uuid,
+                           as_int(self.ibeacon_major), as_int(self.ibeacon_minor),
+                           self.in_time, self.out_time, self.course)
 
     @property
     def serialize(self):
@@ -139,6 +194,164 @@ class Event(db.Model):
         }
 
 
+class Watermark(db.Model):
+    "Last beacons row id searched for events, per gate"
+    __tablename__ = 'watermarks'
+
+    gate_id = db.Column(db.Integer, primary_key=True)
+    beacon_id = db.Column(db.Integer)
+
+
+# gate as kept in GateRegistry, valid outside of db session
+GateInfo = namedtuple('GateInfo', 'id raspi_serial_left raspi_serial_right distance')
+
+
+class GateRegistry(object):
+    """
+    Gates by agent serial, loaded from db on first use after gates are changed
+    Agent is a side of one gate, add_gate() and update_gate() refuse gates sharing an agent,
+    if older db has such gates the first one gets the agent
+    """
+
+    def __init__(self):
+        self.gates = None  # [GateInfo]
+        self.sides = None  # raspi_serial: (GateInfo, side)
+        self.lock = threading.Lock()
+
+    def invalidate(self):
+        "Reload gates on next use"
+        with self.lock:
+            self.gates = self.sides = None
+
+    def load(self):
+        with self.lock:
+            if self.gates is None:
+                gates = [GateInfo(gate.id, gate.raspi_serial_left, gate.raspi_serial_right, gate.distance)
+                         for gate in Gate.query.order_by(Gate.id)]
+                sides = {}
+                for gate in gates:
+                    for serial, side in ((gate.raspi_serial_left, 'left'), (gate.raspi_serial_right, 'right')):
+                        if serial in sides:
+                            app.logger.warning('Agent %s is in gates %s and %s', serial, sides[serial][0].id, gate.id)
+                        else:
+                            sides[serial] = (gate, side)
+                self.gates, self.sides = gates, sides
+            return self.gates, self.sides
+
+    def all(self):
+        "Returns all gates"
+        return self.load()[0]
+
+    def get(self, raspi_serial):
+        "Returns (gate, side) of agent, (None, None) if it is not in any gate"
+        return self.load()[1].get(raspi_serial, (None, None))
+
+
+gate_registry = GateRegistry()
+
+
+def shares_agent(content, id=None):
+    "Returns True if posted gate has the same agent on both sides or an agent of gate other than id"
+    serials = (content.get('raspi_serial_left'), content.get('raspi_serial_right'))
+    if serials[0] == serials[1]:
+        return True
+    for serial in serials:
+        gate, side = gate_registry.get(serial)
+        if gate is not None and gate.id != id:
+            return True
+    return False
+
+
+def tag_message(message):
+    "Sets gate_id and side of message by its agent"
+    gate, message.side = gate_registry.get(message.raspi_serial)
+    message.gate_id = gate.id if gate is not None else None
+
+
+def retag_messages(serials):
+    "Reloads gates, updates gate_id and side of all messages of agents"
+    gate_registry.invalidate()
+    for serial in set(serials):
+        gate, side = gate_registry.get(serial)
+        Beacon.query.filter(Beacon.raspi_serial == serial).update(
+            {Beacon.gate_id: gate.id if gate is not None else None, Beacon.side: side}, synchronize_session=False)
+    db.session.commit()
+
+
+class RecentKeys(object):
+    """
+    LRU set of natural keys known to be in db
+    Client retries are answered from here without touching db
+    """
+
+    def __init__(self, size=RECENT_KEYS_SIZE):
+        self.size = size
+        self.keys = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            if key not in self.keys:
+                return False
+            del self.keys[key]
+            self.keys[key] = True
+            return True
+
+    def add(self, keys):
+        "Remembers keys, call after commit only"
+        with self.lock:
+            for key in keys:
+                self.keys.pop(key, None)
+                self.keys[key] = True
+            while len(self.keys) > self.size:
+                self.keys.popitem(last=False)
+
+    def discard(self, keys):
+        "Forgets keys of deleted or changed records"
+        with self.lock:
+            for key in keys:
+                self.keys.pop(key, None)
+
+
+recent_keys = RecentKeys()
+
+
+def store(record):
+    """
+    Inserts record unless one with the same natural key exists, returns False for duplicates
+    Record is not added to session, its natural_key is set
+    """
+    record.natural_key = record.make_key()
+    if record.natural_key in recent_keys:
+        return False
+    result = db.session.execute(insert_ignore(record.__table__), row_values(record))
+    return result.rowcount == 1
+
+
+def store_all(records):
+    "Bulk inserts records of one model, duplicates are skipped"
+    if records:
+        for record in records:
+            record.natural_key = record.make_key()
+        db.session.execute(insert_ignore(records[0].__table__), [row_values(record) for record in records])
+
+
+def insert_ignore(table):
+    "INSERT statement which skips rows conflicting with unique index"
+    return table.insert().prefix_with('OR IGNORE', dialect='sqlite')
+
+
+def row_values(record):
+    "Column values of record for insert"
+    return dict((column.name, getattr(record, column.name)) for column in record.__table__.columns
+                if column.name != 'id')
+
+
+def forget(model, id):
+    "Drops natural key of record with given id from recent keys"
+    recent_keys.discard([key for key, in db.session.query(model.natural_key).filter(model.id == id)])
+
+
 """
  ****************** MESSAGES ******************
 """
@@ -151,36 +364,92 @@ def get_messages():
     return jsonify([i.serialize for i in content]), 200
 
 
+def message_from_json(content):
+    "Makes Beacon from posted message, raises on invalid one, does not touch db"
+    return Beacon(raspi_serial=content.get('raspi_serial'),
+                  ibeacon_uuid=content.get('ibeacon_uuid'),
+                  ibeacon_major=as_int(content.get('ibeacon_major')),
+                  ibeacon_minor=as_int(content.get('ibeacon_minor')),
+                  in_time=parser.parse(content.get('in_time')),
+                  out_time=parser.parse(content.get('out_time')),
+                  min_dist=int(float(content.get('min_dist'))),
+                  min_time=parser.parse(content.get('min_time')))
+
+
 @app.route('/api/messages/', methods=['POST'])
 def add_message():
     "Inputs new message and saves it in db"
     content = request.get_json(silent=True, force=False)
     if content:
-        new_message = Beacon(raspi_serial=content.get('raspi_serial'),
-                             ibeacon_uuid=content.get('ibeacon_uuid'),
-                             ibeacon_major=content.get('ibeacon_major'),
-                             ibeacon_minor=content.get('ibeacon_minor'),
-                             in_time=parser.parse(content.get('in_time')),
-                             out_time=parser.parse(content.get('out_time')),
-                             min_dist=int(float(content.get('min_dist'))), 
-                             min_time=parser.parse(content.get('min_time')))
-        # check if same record exists
-        if db.session.query(Beacon.id).filter((Beacon.raspi_serial == new_message.raspi_serial) &
-                                                      (Beacon.ibeacon_uuid == new_message.ibeacon_uuid) &
-                                                      (Beacon.ibeacon_major == new_message.ibeacon_major) &
-                                                      (Beacon.ibeacon_minor == new_message.ibeacon_minor) &
-                                                      (Beacon.in_time == new_message.in_time) &
-                                                      (Beacon.out_time == new_message.out_time) &
-                                                      (Beacon.min_dist == new_message.min_dist) &
-                                                      (Beacon.min_time == new_message.min_time)).count() == 0:
-            db.session.add(new_message)
-            return "<h1>Ok</h1>", 200
-        else:
+        try:
+            new_message = message_from_json(content)
+        except:
             return "<h1>Error</h1>", 400
+        try:
+            tag_message(new_message)
+            if not store(new_message):
+                return "<h1>Error</h1>", 400
+            db.session.commit()
+        except:
+            db.session.rollback()
+            app.logger.exception('Cannot store message')
+            return "<h1>Error</h1>", 503
+        recent_keys.add([new_message.natural_key])
+        stream_events([new_message])
+        return "<h1>Ok</h1>", 200
     else:
         return "<h1>Error</h1>", 400
 
 
+@app.route('/api/messages/batch', methods=['POST'])
+def add_messages():
+    """
+    Inputs array of messages (optionally gzip-compressed), saves them in db
+    Returns array of {"status": "ok" | "duplicate" | "error"}, one for every message,
+    error is for invalid messages only, db failures fail the whole request with 503 so that client retries
+    """
+    try:
+        data = request.get_data()
+        if request.headers.get('Content-Encoding') == 'gzip':
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        content = json.loads(data.decode('utf-8'))
+    except:
+        return "<h1>Error</h1>", 400
+    if not isinstance(content, list):
+        return "<h1>Error</h1>", 400
+
+    messages = []
+    for item in content:
+        try:
+            messages.append(message_from_json(item))
+        except:
+            messages.append(None)
+
+    results = []
+    keys = []
+    stored = []
+    try:
+        for new_message in messages:
+            if new_message is None:
+                results.append({'status': 'error'})
+                continue
+            tag_message(new_message)
+            if store(new_message):
+                results.append({'status': 'ok'})
+                stored.append(new_message)
+            else:
+                results.append({'status': 'duplicate'})
+            keys.append(new_message.natural_key)
+        db.session.commit()
+    except:
+        db.session.rollback()
+        app.logger.exception('Cannot store messages')
+        return "<h1>Error</h1>", 503
+    recent_keys.add(keys)
+    stream_events(stored)
+    return jsonify(results), 200
+
+
 @app.route('/api/messages/<int:id>', methods=['PUT'])
 def update_message(id):
     "Update message with given id"
@@ -188,6 +457,7 @@ def update_message(id):
     if content:
         try:
             message = Beacon.query.filter(Beacon.id == id).first()
+            recent_keys.discard([message.natural_key])
             message.raspi_serial = content.get('raspi_serial')
             message.ibeacon_uuid = content.get('ibeacon_uuid')
             message.ibeacon_major = content.get('ibeacon_major')
@@ -196,9 +466,13 @@ def update_message(id):
             message.out_time = parser.parse(content.get('out_time'))
             message.min_dist = int(content.get('min_dist'))
             message.min_time = parser.parse(content.get('min_time'))
+            message.natural_key = message.make_key()
+            tag_message(message)
 
             db.session.commit()
+            open_visits.reset()
         except:
+            db.session.rollback()
             return "<h1>Error</h1>", 404
     else:
         return "<h1>Error</h1>", 400
@@ -209,7 +483,9 @@ def update_message(id):
 def delete_message(id):
     "Delete message with given id"
     try:
+        forget(Beacon, id)
         Beacon.query.filter(Beacon.id == id).delete(synchronize_session='evaluate')
+        open_visits.reset()
     except:
         return "<h1>Error</h1>", 404
     return "<h1>Ok</h1>", 200
@@ -232,14 +508,15 @@ def add_gate():
     "Inputs new gate and saves it in db"
     content = request.get_json(silent=True, force=False)
     if content:
+        if shares_agent(content):
+            return "<h1>Error</h1>", 400
         new_gate = Gate(raspi_serial_left=content.get('raspi_serial_left'),
                         raspi_serial_right=content.get('raspi_serial_right'),
                         distance=content.get('distance'))
-        # check if same record exists
-        if db.session.query(Gate.id).filter((Gate.raspi_serial_left == new_gate.raspi_serial_left) &
-                                                    (Gate.raspi_serial_right == new_gate.raspi_serial_right) &
-                                                    (Gate.distance == new_gate.distance)).count() == 0:
-            db.session.add(new_gate)
+        if store(new_gate):
+            db.session.commit()
+            recent_keys.add([new_gate.natural_key])
+            retag_messages([new_gate.raspi_serial_left, new_gate.raspi_serial_right])
             return "<h1>Ok</h1>", 200
         else:
             return "<h1>Error</h1>", 400
@@ -252,14 +529,22 @@ def update_gate(id):
     "Update gate with given id"
     content = request.get_json(silent=True, force=False)
     if content:
+        if shares_agent(content, id):
+            return "<h1>Error</h1>", 400
         try:
             gate = Gate.query.filter(Gate.id == id).first()
+            recent_keys.discard([gate.natural_key])
+            serials = [gate.raspi_serial_left, gate.raspi_serial_right]
             gate.raspi_serial_left = content.get('raspi_serial_left')
             gate.raspi_serial_right = content.get('raspi_serial_right')
             gate.distance = content.get('distance')
+            gate.natural_key = gate.make_key()
+            Watermark.query.filter(Watermark.gate_id == id).delete()
 
             db.session.commit()
+            retag_messages(serials + [gate.raspi_serial_left, gate.raspi_serial_right])
         except:
+            db.session.rollback()
             return "<h1>Error</h1>", 404
     else:
         return "<h1>Error</h1>", 400
@@ -290,15 +575,9 @@ def add_event():
                           in_time=parser.parse(content.get('in_time')),
                           out_time=parser.parse(content.get('out_time')),
                           course=content.get('course'))
-        # check if same record exists
-        if db.session.query(Event.id).filter((Event.gate_id == new_event.gate_id) &
-                                                     (Event.ibeacon_uuid == new_event.ibeacon_uuid) &
-                                                     (Event.ibeacon_major == new_event.ibeacon_major) &
-                                                     (Event.ibeacon_minor == new_event.ibeacon_minor) &
-                                                     (Event.in_time == new_event.in_time) &
-                                                     (Event.out_time == new_event.out_time) &
-                                                     (Event.course == new_event.course)).count() == 0:
-            db.session.add(new_event)
+        if store(new_event):
+            db.session.commit()
+            recent_keys.add([new_event.natural_key])
             return "<h1>Ok</h1>", 200
         else:
             return "<h1>Error</h1>", 400
@@ -313,6 +592,7 @@ def update_event(id):
     if content:
         try:
             event = Event.query.filter(Event.id == id).first()
+            recent_keys.discard([event.natural_key])
             event.gate_id = content.get('gate_id')
             event.ibeacon_uuid = content.get('ibeacon_uuid')
             event.ibeacon_major = content.get('ibeacon_major')
@@ -320,9 +600,11 @@ def update_event(id):
             event.in_time = parser.parse(content.get('in_time'))
             event.out_time = parser.parse(content.get('out_time'))
             event.course = content.get('course')
+            event.natural_key = event.make_key()
 
             db.session.commit()
         except:
+            db.session.rollback()
             return "<h1>Error</h1>", 404
     else:
         return "<h1>Error</h1>", 400
@@ -333,6 +615,7 @@ def update_event(id):
 def delete_event(id):
     "Delete event with given id"
     try:
+        forget(Event, id)
         Event.query.filter(Event.id == id).delete(synchronize_session='evaluate')
     except:
         return "<h1>Error</h1>", 404
@@ -368,105 +651,256 @@ def events():
 def delete_gate(id):
     "Delete gate with given id"
     try:
+        forget(Gate, id)
+        serials = db.session.query(Gate.raspi_serial_left, Gate.raspi_serial_right).filter(Gate.id == id).first() or []
         Gate.query.filter(Gate.id == id).delete(synchronize_session='evaluate')
+        Watermark.query.filter(Watermark.gate_id == id).delete()
+        db.session.commit()
+        retag_messages(serials)
     except:
         return "<h1>Error</h1>", 404
     return "<h1>Ok</h1>", 200
 
 
+def gate_course(gate, dist_left, dist_right):
+    "Course through gate by beacon min distances to left and right agents"
+    if dist_left > gate.distance or dist_right > gate.distance:
+        return 'wide'
+    elif dist_left <= dist_right // 2:
+        return 'left'
+    elif dist_right <= dist_left // 2:
+        return 'right'
+    return 'center'
+
+
+def make_event(gate, first, second):
+    "Event of gate made by overlapping visits, second starts while first lasts"
+    left, right = (first, second) if first.raspi_serial == gate.raspi_serial_left else (second, first)
+    return Event(gate_id=gate.id,
+                 ibeacon_uuid=first.ibeacon_uuid,
+                 ibeacon_major=first.ibeacon_major,
+                 ibeacon_minor=first.ibeacon_minor,
+                 in_time=first.in_time,
+                 out_time=second.out_time,
+                 min_time_left=left.min_time,
+                 min_time_right=right.min_time,
+                 course=gate_course(gate, left.min_dist, right.min_dist))
+
+
+def overlaps(visits, since_id):
+    """
+    Sweep line over visits of one beacon ordered by in_time
+    Yields (first, second) visits on opposite sides of gate where second starts while first lasts,
+    only pairs with a visit newer than since_id
+    """
+    active = {}  # raspi_serial: visits lasting at current in_time
+    for visit in visits:
+        for serial, lasting in active.items():
+            lasting = active[serial] = [other for other in lasting if other.out_time > visit.in_time]
+            if serial != visit.raspi_serial:
+                for other in lasting:
+                    if other.in_time < visit.in_time and (visit.id > since_id or other.id > since_id):
+                        yield other, visit
+        active.setdefault(visit.raspi_serial, []).append(visit)
+
+
+def collect_events(gate, last_id):
+    """
+    Finds events of gate in beacons rows added after its watermark up to last_id
+    Two indexed queries, combined by UNION ALL: new rows by id range and older rows lasting until
+    the earliest new visit by out_time range, so a run reads new data and its overlaps, not all history
+    Returns new Events, moves watermark to last_id
+    """
+    watermark = db.session.query(Watermark.beacon_id).filter(Watermark.gate_id == gate.id).scalar() or 0
+    since = db.session.query(db.func.min(Beacon.in_time)).filter(Beacon.gate_id == gate.id,
+                                                                 Beacon.id > watermark,
+                                                                 Beacon.id <= last_id).scalar()
+    events = []
+    if since is not None:
+        columns = (Beacon.id, Beacon.raspi_serial, Beacon.ibeacon_uuid, Beacon.ibeacon_major, Beacon.ibeacon_minor,
+                   Beacon.in_time, Beacon.out_time, Beacon.min_dist, Beacon.min_time)
+        new = db.session.query(*columns).filter(Beacon.gate_id == gate.id,
+                                                Beacon.id > watermark,
+                                                Beacon.id <= last_id)
+        old = db.session.query(*columns).filter(Beacon.gate_id == gate.id,
+                                                Beacon.out_time > since,
+                                                Beacon.id <= watermark)
+        query = new.union_all(old).order_by(Beacon.ibeacon_uuid, Beacon.ibeacon_major, Beacon.ibeacon_minor,
+                                            Beacon.in_time)
+        for identity, visits in groupby(query, lambda visit: visit[2:5]):
+            for first, second in overlaps(visits, watermark):
+                events.append(make_event(gate, first, second))
+    db.session.merge(Watermark(gate_id=gate.id, beacon_id=last_id))
+    return events
+
+
+# beacon visit as kept in OpenVisits
+Visit = namedtuple('Visit', 'raspi_serial ibeacon_uuid ibeacon_major ibeacon_minor in_time out_time min_dist min_time')
+
+
+class OpenVisits(object):
+    """
+    Recent visits by beacon identity and agent serial
+    Every stored message is checked against visits of the same beacon on the other side of its gate,
+    events are made as soon as the second visit comes in.
+    Index is built from db on first use and after messages are changed, visits ended more than
+    horizon before the newest one are dropped. Late messages are left to /api/collect_items/
+    """
+
+    def __init__(self, horizon=OPEN_VISITS_HORIZON):
+        self.horizon = horizon
+        self.visits = None  # (uuid, major, minor): {raspi_serial: [Visit]}
+        self.latest = None  # newest in_time
+        self.added = 0
+        self.lock = threading.Lock()
+
+    def reset(self):
+        "Rebuild index on next use"
+        with self.lock:
+            self.visits = None
+
+    def load(self):
+        "Builds index from recent beacons rows"
+        self.visits = {}
+        self.latest = db.session.query(db.func.max(Beacon.in_time)).scalar()
+        if self.latest is not None:
+            query = db.session.query(*[getattr(Beacon, field) for field in Visit._fields])
+            for row in query.filter(Beacon.out_time > self.latest - self.horizon):
+                self.insert(Visit(*row))
+
+    def insert(self, visit):
+        identity = visit[1:4]
+        self.visits.setdefault(identity, {}).setdefault(visit.raspi_serial, []).append(visit)
+        if self.latest is None or visit.in_time > self.latest:
+            self.latest = visit.in_time
+
+    def prune(self):
+        "Drops visits ended before horizon"
+        oldest = self.latest - self.horizon
+        for identity in list(self.visits):
+            sides = self.visits[identity]
+            for serial in list(sides):
+                sides[serial] = [visit for visit in sides[serial] if visit.out_time > oldest]
+                if not sides[serial]:
+                    del sides[serial]
+            if not sides:
+                del self.visits[identity]
+        self.added = 0
+
+    def add(self, messages):
+        "Indexes stored messages, returns Events made by them"
+        events = []
+        with self.lock:
+            if self.visits is None:
+                self.load()
+            for message in messages:
+                visit = Visit(message.raspi_serial, message.ibeacon_uuid, as_int(message.ibeacon_major),
+                              as_int(message.ibeacon_minor), message.in_time, message.out_time,
+                              as_int(message.min_dist), message.min_time)
+                gate, side = gate_registry.get(visit.raspi_serial)
+                if gate is not None and gate.raspi_serial_left != gate.raspi_serial_right:
+                    other_serial = gate.raspi_serial_right if side == 'left' else gate.raspi_serial_left
+                    for other in self.visits.get(visit[1:4], {}).get(other_serial, ()):
+                        if other.in_time < visit.in_time < other.out_time:
+                            events.append(make_event(gate, other, visit))
+                        elif visit.in_time < other.in_time < visit.out_time:
+                            events.append(make_event(gate, visit, other))
+                self.insert(visit)
+            self.added += len(messages)
+            if self.added >= OPEN_VISITS_PRUNE:
+                self.prune()
+        return events
+
+
+open_visits = OpenVisits()
+
+
+def stream_events(messages):
+    "Stores events made by just committed messages, ingest does not depend on it"
+    if messages:
+        try:
+            store_all(open_visits.add(messages))
+            db.session.commit()
+        except:
+            db.session.rollback()
+            open_visits.reset()
+            app.logger.exception('Cannot store events')
+
+
 @app.route('/api/collect_items/', methods=['GET'])
 def process_overlapps():
     """
-    Find overlapping events in Beacon model for all gates from Pair
-    If found, calculate course
-    Store to Event
-
-    select b1.raspi_serial raspi_one, b1.min_dist dist_one, b2.min_dist dist_two, b1.ibeacon_uuid, b1.ibeacon_major, b1.ibeacon_minor, b1.in_time, b2.out_time
-    from beacons b1
-    inner join beacons b2
-    on b1.ibeacon_uuid = b2.ibeacon_uuid 
-    and b1.ibeacon_major = b2.ibeacon_major 
-    and b1.ibeacon_minor = b2.ibeacon_minor
-    and b1.in_time < b2.in_time
-    and b1.out_time > b2.in_time
-    where b1.raspi_serial = "000000000f6570bb" or b1.raspi_serial = "00000000f56eacba"
+    Find overlapping visits of the same beacon on both sides of every gate, store them as Events
+    Every run searches only beacons added since previous one
     """
     try:
-        gates = Gate.query.all()  # List of all available gates
-        for gate in gates:
-            # alias, SQLAlchemy cannot join table to itself
-            b1 = aliased(Beacon)
-            b2 = aliased(Beacon)
-
-            query = db.session.query(b1.raspi_serial.label('raspi_one'),
-                                     b1.min_dist.label('dist_one'),
-                                     b2.min_dist.label('dist_two'),
-                                     b1.ibeacon_uuid,
-                                     b1.ibeacon_major,
-                                     b1.ibeacon_minor,
-                                     b1.in_time,
-                                     b2.out_time,
-                                     b1.min_time.label('time_one'),
-                                     b2.min_time.label('time_two'))
-            # sub_query filters records for current gate
-            query = query.filter((b1.raspi_serial == gate.raspi_serial_left) |
-                                 (b1.raspi_serial == gate.raspi_serial_right))
-            # main query, seek for overlapping time intervals for each i-beacon
-            query = query.join(b2, (b1.in_time < b2.in_time) &
-                               (b1.out_time > b2.in_time) &
-                               (b1.ibeacon_uuid == b2.ibeacon_uuid) &
-                               (b1.ibeacon_major == b2.ibeacon_major) &
-                               (b1.ibeacon_minor == b2.ibeacon_minor))
-            records = query.all()
-
-            for record in records:
-                # Find left and right side's distance
-                if record.raspi_one in db.session.query(Gate.raspi_serial_left).all()[0]:
-                    dist_left = record.dist_one
-                    time_left = record.time_one
-                    dist_right = record.dist_two
-                    time_right = record.time_two
-                else:
-                    dist_right = record.dist_one
-                    time_right = record.time_one
-                    dist_left = record.dist_two
-                    time_left = record.time_two
-
-                # Find course
-                if dist_left > gate.distance or dist_right > gate.distance:
-                    course = 'wide'
-                elif dist_left <= dist_right // 2:
-                    course = 'left'
-                elif dist_right <= dist_left // 2:
-                    course = 'right'
-                else:
-                    course = 'center'
-
-                new_event = Event(gate_id=gate.id,
-                                  ibeacon_uuid=record.ibeacon_uuid,
-                                  ibeacon_major=record.ibeacon_major,
-                                  ibeacon_minor=record.ibeacon_minor,
-                                  in_time=record.in_time,
-                                  out_time=record.out_time,
-                                  min_time_left = time_left,
-                                  min_time_right = time_right,
-                                  course=course)
-                if db.session.query(Event.id).filter((Event.gate_id == new_event.gate_id) &
-                                                             (Event.ibeacon_uuid == new_event.ibeacon_uuid) &
-                                                             (Event.ibeacon_major == new_event.ibeacon_major) &
-                                                             (Event.ibeacon_minor == new_event.ibeacon_minor) &
-                                                             (Event.in_time == new_event.in_time) &
-                                                             (Event.out_time == new_event.out_time) &
-                                                             (Event.min_time_left == new_event.min_time_left) &
-                                                             (Event.min_time_right == new_event.min_time_right) &
-                                                             (Event.course == new_event.course)).count() == 0:
-                    db.session.add(new_event)
-
+        last_id = db.session.query(db.func.max(Beacon.id)).scalar() or 0
+        for gate in gate_registry.all():
+            store_all(collect_events(gate, last_id))
+        db.session.commit()
     except:
+        db.session.rollback()
         return "<h1>Error</h1>", 400
     return "<h1>Ok</h1>", 200
 
 
+# columns added to tables after they were first created
+UPGRADE_COLUMNS = [('beacons', 'natural_key', 'VARCHAR(40)'),
+                   ('beacons', 'gate_id', 'INTEGER'),
+                   ('beacons', 'side', 'VARCHAR(5)'),
+                   ('gates', 'natural_key', 'VARCHAR(40)'),
+                   ('events', 'natural_key', 'VARCHAR(40)')]
+
+
+@app.cli.command('upgrade-db')
+def upgrade_db():
+    """
+    Upgrades older db: creates missing tables and columns, fills natural keys in,
+    deletes duplicate records keeping the oldest one, tags messages with gates and creates indexes
+    """
+    db.create_all()
+    for table, column, column_type in UPGRADE_COLUMNS:
+        columns = [row[1] for row in db.session.execute('PRAGMA table_info({})'.format(table))]
+        if column not in columns:
+            db.session.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table, column, column_type))
+    db.session.commit()
+
+    for model in (Beacon, Gate, Event):
+        table = model.__tablename__
+        seen = set()
+        duplicates = []
+        filled = 0
+        for record in model.query.order_by(model.id).all():
+            key = record.make_key()
+            if key in seen:
+                duplicates.append(record.id)
+            else:
+                seen.add(key)
+                if record.natural_key != key:
+                    record.natural_key = key
+                    filled += 1
+        for i in range(0, len(duplicates), 500):
+            model.query.filter(model.id.in_(duplicates[i:i + 500])).delete(synchronize_session=False)
+        db.session.commit()
+        db.session.execute('CREATE UNIQUE INDEX IF NOT EXISTS ix_{0}_natural_key ON {0} (natural_key)'.format(table))
+        db.session.commit()
+        print('{}: {} keys filled, {} duplicates deleted'.format(table, filled, len(duplicates)))
+
+    retag_messages([serial for serial, in db.session.query(Beacon.raspi_serial).distinct()])
+    db.session.execute('CREATE INDEX IF NOT EXISTS ix_beacons_gate_visit '
+                       'ON beacons (gate_id, ibeacon_uuid, ibeacon_major, ibeacon_minor, in_time)')
+    db.session.execute('CREATE INDEX IF NOT EXISTS ix_beacons_gate_id ON beacons (gate_id, id)')
+    db.session.execute('CREATE INDEX IF NOT EXISTS ix_beacons_gate_out_time ON beacons (gate_id, out_time)')
+    db.session.commit()
+    print('beacons: tagged with {} gates'.format(len(gate_registry.all())))
+    gates, sides = gate_registry.load()
+    for gate in gates:
+        for serial in (gate.raspi_serial_left, gate.raspi_serial_right):
+            if sides[serial][0] is not gate:
+                print('gate {}: agent {} belongs to gate {}, edit gates so that every agent is in one gate'.format(
+                    gate.id, serial, sides[serial][0].id))
+
+
 @app.errorhandler(404)
 def page_not_found(e):
     "404 error handler"